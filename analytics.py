@@ -0,0 +1,400 @@
+#!/usr/bin/python3 -u
+
+import argparse
+import datetime
+import time
+from typing import List
+
+import persistence
+
+ANALYTICS_DEFAULT_HOST = 'localhost'
+ANALYTICS_DEFAULT_LIMIT = 25
+
+# the line history fields that we treat as markets
+MARKETS = [
+    'away_team_spread',
+    'away_team_moneyline',
+    'home_team_spread',
+    'home_team_moneyline',
+    'over_under'
+]
+
+# a spread of zero is only a missing line when it has no odds either;
+# otherwise it is a pick'em
+SPREAD_ODDS = {
+    'away_team_spread': 'away_team_odds',
+    'home_team_spread': 'home_team_odds'
+}
+
+REPORT_OPEN_CLOSE = 'open-close'
+REPORT_MOVERS = 'movers'
+REPORT_HOURLY = 'hourly'
+REPORT_KENPOM_EDGE = 'kenpom-edge'
+REPORTS = [REPORT_OPEN_CLOSE, REPORT_MOVERS, REPORT_HOURLY, REPORT_KENPOM_EDGE]
+
+def create_analytics_indexes(
+    database) -> None:
+
+    # the date filters match on snapshot timestamps, which are stored as
+    # 'YYYY-MM-DD HH:MM:SS' strings and can use a prefix match.
+    database.events.create_index('betting_lines.last_updated')
+
+    return
+
+def create_implied_probability_expression(
+    moneyline: str) -> dict:
+
+    # american odds to implied probability; a moneyline of 0 means the line
+    # was missing and yields null so it drops out of any comparison.
+    expression = {
+        '$switch': {
+            'branches': [
+                {
+                    'case': {'$eq': [moneyline, 0]},
+                    'then': None
+                },
+                {
+                    'case': {'$gt': [moneyline, 0]},
+                    'then': {'$divide': [100, {'$add': [moneyline, 100]}]}
+                }
+            ],
+            'default': {'$divide': [{'$multiply': [moneyline, -1]}, {'$subtract': [100, moneyline]}]}
+        }
+    }
+
+    return expression
+
+def create_kenpom_edge_expression(
+    team: str,
+    moneyline: str) -> dict:
+
+    # kenpom gives the probability of the predicted winner; flip it for the
+    # other side so that each team gets its own win probability.
+    probability = {
+        '$cond': [
+            {'$eq': ['$$prediction.winning_team', team]},
+            '$$prediction.confidence',
+            {'$subtract': [1, '$$prediction.confidence']}
+        ]
+    }
+
+    implied = create_implied_probability_expression(moneyline)
+
+    return {'$cond': [{'$eq': [implied, None]}, None, {'$subtract': [probability, implied]}]}
+
+def create_quoted_values_expression(
+    market: str) -> dict:
+
+    # missing lines are stored as zero, which would otherwise pull the low
+    # or high of the range to zero
+    quoted = {'$ne': [f'$$snapshot.{market}', 0]}
+    if market in SPREAD_ODDS:
+        quoted = {'$or': [quoted, {'$not': [{'$in': [{'$ifNull': [f'$$snapshot.{SPREAD_ODDS[market]}', 0]}, [0, '']]}]}]}
+
+    return {
+        '$map': {
+            'input': {'$filter': {'input': '$betting_lines', 'as': 'snapshot', 'cond': quoted}},
+            'as': 'snapshot',
+            'in': f'$$snapshot.{market}'
+        }
+    }
+
+def create_open_close_pipeline(
+    event_ids: List[str]) -> List[dict]:
+
+    match = {'betting_lines.0': {'$exists': True}}
+    if event_ids:
+        match['event_id'] = {'$in': event_ids}
+
+    project = {
+        '_id': 0,
+        'event_id': 1,
+        'game_date': 1,
+        'away_team': 1,
+        'home_team': 1,
+        'snapshots': {'$size': '$betting_lines'}
+    }
+
+    movement = {}
+    for market in MARKETS:
+        project[market] = {
+            'open': {'$arrayElemAt': [f'$betting_lines.{market}', 0]},
+            'close': {'$arrayElemAt': [f'$betting_lines.{market}', -1]},
+            'low': {'$min': create_quoted_values_expression(market)},
+            'high': {'$max': create_quoted_values_expression(market)}
+        }
+        movement[f'{market}.movement'] = {'$subtract': [f'${market}.close', f'${market}.open']}
+
+    pipeline = [
+        {'$match': match},
+        {'$project': project},
+        {'$addFields': movement},
+        {'$sort': {'event_id': 1}}
+    ]
+
+    return pipeline
+
+def create_movers_pipeline(
+    day: str,
+    market: str,
+    limit: int) -> List[dict]:
+
+    # only consider the snapshots taken on the requested day, so that the
+    # movement reflects what happened today rather than since opening.
+    pipeline = [
+        {'$match': {'betting_lines.last_updated': {'$regex': f'^{day}'}}},
+        {'$project': {
+            '_id': 0,
+            'event_id': 1,
+            'game_date': 1,
+            'away_team': 1,
+            'home_team': 1,
+            'day_lines': {
+                '$filter': {
+                    'input': '$betting_lines',
+                    'as': 'snapshot',
+                    'cond': {'$eq': [{'$substrBytes': ['$$snapshot.last_updated', 0, 10]}, day]}
+                }
+            }
+        }},
+        {'$project': {
+            'event_id': 1,
+            'game_date': 1,
+            'away_team': 1,
+            'home_team': 1,
+            'snapshots': {'$size': '$day_lines'},
+            'open': {'$arrayElemAt': [f'$day_lines.{market}', 0]},
+            'close': {'$arrayElemAt': [f'$day_lines.{market}', -1]}
+        }},
+        {'$addFields': {
+            'movement': {'$subtract': ['$close', '$open']}
+        }},
+        {'$addFields': {
+            'abs_movement': {'$abs': '$movement'}
+        }},
+        {'$sort': {'abs_movement': -1, 'event_id': 1}},
+        {'$limit': limit}
+    ]
+
+    return pipeline
+
+def create_hourly_pipeline(
+    day: str,
+    market: str) -> List[dict]:
+
+    match = {}
+    if day:
+        match = {'betting_lines.last_updated': {'$regex': f'^{day}'}}
+
+    # bucket every snapshot by hour, take the first and last value seen by
+    # each event in that hour, then total the movement across the slate. the
+    # snapshots are sorted by time first, since $first and $last follow the
+    # order the group receives them in.
+    pipeline = [
+        {'$match': match},
+        {'$unwind': '$betting_lines'},
+        {'$project': {
+            'event_id': 1,
+            'hour': {'$substrBytes': ['$betting_lines.last_updated', 0, 13]},
+            'last_updated': '$betting_lines.last_updated',
+            'value': f'$betting_lines.{market}'
+        }},
+        {'$match': {'hour': {'$regex': f'^{day}'}} if day else {'hour': {'$ne': ''}}},
+        {'$sort': {'event_id': 1, 'last_updated': 1}},
+        {'$group': {
+            '_id': {'event_id': '$event_id', 'hour': '$hour'},
+            'first': {'$first': '$value'},
+            'last': {'$last': '$value'},
+            'snapshots': {'$sum': 1}
+        }},
+        {'$project': {
+            'hour': '$_id.hour',
+            'movement': {'$abs': {'$subtract': ['$last', '$first']}},
+            'snapshots': 1
+        }},
+        {'$group': {
+            '_id': '$hour',
+            'total_movement': {'$sum': '$movement'},
+            'events_moved': {'$sum': {'$cond': [{'$gt': ['$movement', 0]}, 1, 0]}},
+            'events': {'$sum': 1},
+            'snapshots': {'$sum': '$snapshots'}
+        }},
+        {'$sort': {'_id': 1}}
+    ]
+
+    return pipeline
+
+def create_kenpom_edge_pipeline(
+    limit: int) -> List[dict]:
+
+    # snapshots refer to a prediction in kenpom_predictions by kenpom_id;
+    # older snapshots embed it as kenpom_event.
+    prediction = {
+        '$ifNull': [
+            '$$snapshot.kenpom_event',
+            {'$arrayElemAt': [
+                {'$filter': {
+                    'input': '$predictions',
+                    'as': 'stored',
+                    'cond': {'$eq': ['$$stored.kenpom_id', '$$snapshot.kenpom_id']}
+                }},
+                0
+            ]}
+        ]
+    }
+
+    pipeline = [
+        {'$match': {'$or': [
+            {'betting_lines.kenpom_id': {'$exists': True}},
+            {'betting_lines.kenpom_event': {'$exists': True}}
+        ]}},
+        {'$lookup': {
+            'from': 'kenpom_predictions',
+            'localField': 'betting_lines.kenpom_id',
+            'foreignField': 'kenpom_id',
+            'as': 'predictions'
+        }},
+        {'$project': {
+            '_id': 0,
+            'event_id': 1,
+            'game_date': 1,
+            'away_team': 1,
+            'home_team': 1,
+            'edges': {
+                '$map': {
+                    'input': {
+                        '$filter': {
+                            'input': '$betting_lines',
+                            'as': 'snapshot',
+                            'cond': {'$or': [
+                                {'$ne': [{'$type': '$$snapshot.kenpom_id'}, 'missing']},
+                                {'$ne': [{'$type': '$$snapshot.kenpom_event'}, 'missing']}
+                            ]}
+                        }
+                    },
+                    'as': 'snapshot',
+                    'in': {
+                        '$let': {
+                            'vars': {'prediction': prediction},
+                            'in': {
+                                'away': create_kenpom_edge_expression('$away_team', '$$snapshot.away_team_moneyline'),
+                                'home': create_kenpom_edge_expression('$home_team', '$$snapshot.home_team_moneyline')
+                            }
+                        }
+                    }
+                }
+            }
+        }},
+        {'$project': {
+            'event_id': 1,
+            'game_date': 1,
+            'away_team': 1,
+            'home_team': 1,
+            'away_edge_starting': {'$arrayElemAt': ['$edges.away', 0]},
+            'away_edge_latest': {'$arrayElemAt': ['$edges.away', -1]},
+            'home_edge_starting': {'$arrayElemAt': ['$edges.home', 0]},
+            'home_edge_latest': {'$arrayElemAt': ['$edges.home', -1]}
+        }},
+        {'$addFields': {
+            'away_edge_change': {'$subtract': ['$away_edge_latest', '$away_edge_starting']},
+            'home_edge_change': {'$subtract': ['$home_edge_latest', '$home_edge_starting']}
+        }},
+        {'$addFields': {
+            'max_edge_change': {'$max': [{'$abs': '$away_edge_change'}, {'$abs': '$home_edge_change'}]}
+        }},
+        {'$sort': {'max_edge_change': -1, 'event_id': 1}},
+        {'$limit': limit}
+    ]
+
+    return pipeline
+
+def run_pipeline(
+    database,
+    pipeline: List[dict]) -> List[dict]:
+
+    return list(database.events.aggregate(pipeline, allowDiskUse = True))
+
+def print_results(
+    results: List[dict],
+    elapsed: float) -> None:
+
+    for result in results:
+        print(result)
+
+    print(f'{len(results)} results in {elapsed * 1000:.1f} ms')
+
+    return
+
+def main(
+    args: argparse.Namespace) -> None:
+
+    database = persistence.MongoEventClient(args.host).get_database(args.database).database
+    create_analytics_indexes(database)
+
+    if args.report == REPORT_OPEN_CLOSE:
+        pipeline = create_open_close_pipeline(args.event_ids)
+    elif args.report == REPORT_MOVERS:
+        pipeline = create_movers_pipeline(args.date, args.market, args.limit)
+    elif args.report == REPORT_HOURLY:
+        pipeline = create_hourly_pipeline(args.date, args.market)
+    else:
+        pipeline = create_kenpom_edge_pipeline(args.limit)
+
+    start = time.perf_counter()
+    results = run_pipeline(database, pipeline)
+    print_results(results, time.perf_counter() - start)
+
+    return
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description =
+        'Line movement analytics computed server-side over the recorded \
+        event history.')
+
+    parser.add_argument(
+        'report',
+        choices = REPORTS,
+        help = 'Report to run')
+    parser.add_argument(
+        '--database',
+        dest = 'database',
+        required = True,
+        help = 'Database to query (e.g., cfb, ncaam)')
+    parser.add_argument(
+        '--host',
+        dest = 'host',
+        default = ANALYTICS_DEFAULT_HOST,
+        help = 'MongoDB host')
+    parser.add_argument(
+        '--date',
+        dest = 'date',
+        default = str(datetime.date.today()),
+        help = 'Day (YYYY-MM-DD) for the movers and hourly reports')
+    parser.add_argument(
+        '--market',
+        dest = 'market',
+        choices = MARKETS,
+        default = 'away_team_spread',
+        help = 'Market for the movers and hourly reports')
+    parser.add_argument(
+        '--event',
+        action = 'append',
+        dest = 'event_ids',
+        default = [],
+        help = 'Limit the open-close report to these events')
+    parser.add_argument(
+        '--limit',
+        dest = 'limit',
+        type = int,
+        default = ANALYTICS_DEFAULT_LIMIT,
+        help = 'Maximum number of results')
+
+    try:
+        args = parser.parse_args()
+    except Exception as e:
+        print(f'An error occurred: {str(e)}')
+        exit(1)
+
+    main(args)
+    exit(0)
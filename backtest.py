@@ -0,0 +1,334 @@
+#!/usr/bin/python3 -u
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import time
+from typing import List
+
+import numpy as np
+
+import event
+import kelly
+import persistence
+
+BACKTEST_DEFAULT_BACKEND = persistence.DB_BACKEND_SQLITE
+BACKTEST_DEFAULT_HOST = 'localhost'
+BACKTEST_DEFAULT_DIRECTORY = './data'
+
+BACKTEST_DEFAULT_MIN_KELLY = 0.0
+BACKTEST_DEFAULT_MAX_KELLY = 0.5
+BACKTEST_DEFAULT_STEP = 0.01
+BACKTEST_DEFAULT_MULTIPLIERS = [0.25, 0.5, 1.0]
+
+# every rule is a single vectorized pass, so the sweep is evaluated in this
+# process unless more workers are asked for
+BACKTEST_DEFAULT_WORKERS = 1
+
+SNAPSHOT_STARTING = 'starting'
+SNAPSHOT_LATEST = 'latest'
+SNAPSHOTS = [SNAPSHOT_STARTING, SNAPSHOT_LATEST]
+
+# columns of the result matrix returned for every evaluated rule
+RESULT_COLUMNS = [
+    'min_kelly',
+    'bets',
+    'wins',
+    'units',
+    'roi',
+    'kelly_units'
+]
+
+# data shared with the sweep workers; set once per process by the pool
+# initializer so the arrays are not pickled with every task.
+WORKER_DATA = None
+
+
+class BacktestData:
+    '''Columnar arrays of every settled moneyline side in the stored history.'''
+
+    __slots__ = [
+        'event_ids',
+        'sides',
+        'kelly',
+        'returns',
+        'won'
+    ]
+
+    def __init__(
+        self,
+        events: List[event.SingleEvent]):
+
+        # only settled events with a kenpom prediction can be evaluated
+        settled = list(filter(lambda e: e.betting_lines and e.outcome and e.outcome.winning_team, events))
+        slate_kelly = kelly.SlateKelly(settled)
+
+        event_ids = []
+        sides = []
+        kellys = []
+        returns = []
+        won = []
+        for settled_event in settled:
+            start, end = slate_kelly.offsets[settled_event.event_id]
+            snapshots = [start, end - 1]
+
+            for side, team in ((kelly.AWAY, settled_event.away_team), (kelly.HOME, settled_event.home_team)):
+                if np.isnan(slate_kelly.probability[snapshots, side]).all():
+                    continue
+
+                is_winner = settled_event.outcome.winning_team == team
+
+                event_ids.append(settled_event.event_id)
+                sides.append(side)
+                kellys.append(slate_kelly.kelly[snapshots, side])
+                returns.append(np.where(is_winner, slate_kelly.decimal_odds[snapshots, side] - 1, -1.0))
+                won.append(is_winner)
+
+        # kelly and returns hold one column per snapshot (starting, latest)
+        self.event_ids = np.array(event_ids)
+        self.sides = np.array(sides, dtype = int)
+        self.kelly = np.array(kellys, dtype = float).reshape(-1, 2)
+        self.returns = np.array(returns, dtype = float).reshape(-1, 2)
+        self.won = np.array(won, dtype = bool)
+
+        return
+
+def load_backtest_data(
+    database) -> BacktestData:
+
+    return BacktestData(event.load_all_events_from_database(database))
+
+def evaluate_rules(
+    data: BacktestData,
+    snapshot: str,
+    thresholds: np.ndarray,
+    multiplier: float) -> np.ndarray:
+
+    # every rule "bet when kelly > threshold" is evaluated at once: one row
+    # of the mask per threshold, one column per side in the history.
+    column = SNAPSHOTS.index(snapshot)
+    kellys = data.kelly[:, column]
+    returns = data.returns[:, column]
+
+    mask = kellys[None, :] > thresholds[:, None]
+    bets = mask.sum(axis = 1)
+    wins = (mask & data.won[None, :]).sum(axis = 1)
+    units = mask @ returns
+    kelly_units = mask @ (multiplier * kellys * returns)
+    roi = np.divide(units, bets, out = np.zeros(len(thresholds)), where = bets > 0)
+
+    return np.stack([thresholds, bets, wins, units, roi, kelly_units], axis = 1)
+
+def set_worker_data(
+    data: BacktestData) -> None:
+
+    global WORKER_DATA
+    WORKER_DATA = data
+
+    return
+
+def evaluate_worker_rules(
+    snapshot: str,
+    thresholds: np.ndarray,
+    multiplier: float) -> np.ndarray:
+
+    return evaluate_rules(WORKER_DATA, snapshot, thresholds, multiplier)
+
+def run_sweep(
+    data: BacktestData,
+    snapshots: List[str],
+    thresholds: np.ndarray,
+    multipliers: List[float],
+    max_workers: int) -> List[tuple]:
+
+    # each (snapshot, multiplier) pair is one vectorized pass over the whole
+    # threshold grid; the pairs are only spread across processes when more
+    # than one worker is asked for.
+    rules = []
+    for snapshot in snapshots:
+        for multiplier in multipliers:
+            rules.append((snapshot, multiplier))
+
+    if max_workers <= 1:
+        set_worker_data(data)
+        results = list(map(lambda r: evaluate_worker_rules(r[0], thresholds, r[1]), rules))
+    else:
+        with ProcessPoolExecutor(max_workers = max_workers, initializer = set_worker_data, initargs = (data,)) as executor:
+            futures = list(map(lambda r: executor.submit(evaluate_worker_rules, r[0], thresholds, r[1]), rules))
+            results = list(map(lambda f: f.result(), futures))
+
+    return list(zip(rules, results))
+
+def print_sweep(
+    sweep: List[tuple],
+    limit: int) -> None:
+
+    # rank every evaluated rule by kelly-staked profit
+    rows = []
+    for (snapshot, multiplier), results in sweep:
+        for result in results.tolist():
+            rows.append((snapshot, multiplier, *result))
+
+    rows.sort(key = lambda r: r[2 + RESULT_COLUMNS.index('kelly_units')], reverse = True)
+
+    print(f'{"snapshot".ljust(9)} {"mult".rjust(5)} {"kelly >".rjust(8)} {"bets".rjust(6)} {"wins".rjust(6)} {"units".rjust(9)} {"roi".rjust(8)} {"kelly units".rjust(12)}')
+    for row in rows[:limit]:
+        print(f'{row[0].ljust(9)} {row[1]:5.2f} {row[2]:8.2f} {int(row[3]):6d} {int(row[4]):6d} {row[5]:9.2f} {row[6] * 100:7.2f}% {row[7]:12.4f}')
+
+    return
+
+def import_outcomes(
+    database,
+    filename: str) -> int:
+
+    # the csv holds one row per game: event_id, away_score, home_score. team
+    # names are taken from the stored event so they always match the lines.
+    with open(filename, 'r', newline = '') as f:
+        rows = list(csv.DictReader(f))
+
+    found = database.find_events(list(map(lambda r: r['event_id'], rows)))
+
+    updates = []
+    for row in rows:
+        if row['event_id'] not in found:
+            print(f'Skipped unknown event: {row["event_id"]}')
+            continue
+
+        document = found[row['event_id']]
+        outcome = event.EventOutcome()
+        outcome.load_from_scores(
+            document['away_team'],
+            int(row['away_score']),
+            document['home_team'],
+            int(row['home_score']))
+        updates.append((row['event_id'], outcome.create_mongodb_dict()))
+
+    database.set_outcomes(updates)
+
+    return len(updates)
+
+def main(
+    args: argparse.Namespace) -> None:
+
+    client = persistence.create_client(args.backend, host = args.host, directory = args.directory)
+    database = client.get_database(args.database)
+
+    if args.command == 'import-outcomes':
+        count = import_outcomes(database, args.filename)
+        print(f'Imported {count} outcomes into {args.database}')
+        return
+
+    start = time.perf_counter()
+    data = load_backtest_data(database)
+    print(f'Loaded {len(data.won)} settled sides in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    if not len(data.won):
+        print('Nothing to backtest; import outcomes first.')
+        return
+
+    thresholds = np.arange(args.min_kelly, args.max_kelly + args.step / 2, args.step)
+    snapshots = SNAPSHOTS if args.snapshot == 'both' else [args.snapshot]
+
+    start = time.perf_counter()
+    sweep = run_sweep(data, snapshots, thresholds, args.multipliers, args.workers)
+    print(f'Evaluated {len(sweep) * len(thresholds)} rules in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    print_sweep(sweep, args.limit)
+
+    return
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description =
+        'Backtest betting rules against the recorded line history and \
+        imported game outcomes.')
+
+    parser.add_argument(
+        '--backend',
+        dest = 'backend',
+        choices = [persistence.DB_BACKEND_MONGO, persistence.DB_BACKEND_SQLITE],
+        default = BACKTEST_DEFAULT_BACKEND,
+        help = 'Database backend holding the line history')
+    parser.add_argument(
+        '--database',
+        dest = 'database',
+        required = True,
+        help = 'Database to load (e.g., cfb, ncaam)')
+    parser.add_argument(
+        '--host',
+        dest = 'host',
+        default = BACKTEST_DEFAULT_HOST,
+        help = 'MongoDB host')
+    parser.add_argument(
+        '--directory',
+        dest = 'directory',
+        default = BACKTEST_DEFAULT_DIRECTORY,
+        help = 'SQLite database directory')
+
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    outcomes_parser = subparsers.add_parser(
+        'import-outcomes',
+        help = 'Import final scores from a CSV (event_id, away_score, home_score)')
+    outcomes_parser.add_argument(
+        'filename',
+        help = 'CSV file of final scores')
+
+    sweep_parser = subparsers.add_parser(
+        'sweep',
+        help = 'Evaluate "bet when Kelly > x" rules over a grid of thresholds')
+    sweep_parser.add_argument(
+        '--snapshot',
+        dest = 'snapshot',
+        choices = SNAPSHOTS + ['both'],
+        default = 'both',
+        help = 'Snapshot the Kelly value is taken from')
+    sweep_parser.add_argument(
+        '--min-kelly',
+        dest = 'min_kelly',
+        type = float,
+        default = BACKTEST_DEFAULT_MIN_KELLY,
+        help = 'Lowest Kelly threshold')
+    sweep_parser.add_argument(
+        '--max-kelly',
+        dest = 'max_kelly',
+        type = float,
+        default = BACKTEST_DEFAULT_MAX_KELLY,
+        help = 'Highest Kelly threshold')
+    sweep_parser.add_argument(
+        '--step',
+        dest = 'step',
+        type = float,
+        default = BACKTEST_DEFAULT_STEP,
+        help = 'Kelly threshold step')
+    sweep_parser.add_argument(
+        '--multiplier',
+        action = 'append',
+        dest = 'multipliers',
+        type = float,
+        default = None,
+        help = 'Fractional Kelly multiplier (repeatable)')
+    sweep_parser.add_argument(
+        '--workers',
+        dest = 'workers',
+        type = int,
+        default = BACKTEST_DEFAULT_WORKERS,
+        help = 'Number of processes used for the sweep (1 runs in-process)')
+    sweep_parser.add_argument(
+        '--limit',
+        dest = 'limit',
+        type = int,
+        default = 25,
+        help = 'Number of best rules to print')
+
+    try:
+        args = parser.parse_args()
+    except Exception as e:
+        print(f'An error occurred: {str(e)}')
+        exit(1)
+
+    if args.command == 'sweep' and not args.multipliers:
+        args.multipliers = BACKTEST_DEFAULT_MULTIPLIERS
+
+    main(args)
+    exit(0)
@@ -0,0 +1,279 @@
+#!/usr/bin/python3 -u
+
+import argparse
+import datetime
+import json
+from os import path
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import downsample
+import event
+import kenpom
+
+BENCHMARK_DEFAULT_SNAPSHOTS = 500
+BENCHMARK_DEFAULT_REPEAT = 20
+
+# a saved fanmatch page kept in the tree so the parser benchmark can be run
+# without kenpom credentials
+BENCHMARK_FANMATCH_PAGE = path.join(path.dirname(path.abspath(__file__)), 'fixtures', 'fanmatch.html')
+
+# cold import of dk.py, which every one-shot docker run pays before main()
+BENCHMARK_IMPORT_BUDGET_MS = 200
+BENCHMARK_IMPORT_RUNS = 7
+
+# modules that are only imported once a feature that needs them is used
+HEAVY_MODULES = [
+    'plotly',
+    'pandas',
+    'selenium',
+    'bs4',
+    'googleapiclient',
+    'numpy'
+]
+
+# run in a fresh interpreter so nothing is already imported
+IMPORT_CHECK_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import dk
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(set(m.split('.')[0] for m in sys.modules))}))
+'''
+
+DIV_ID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+def create_benchmark_event(
+    snapshots: int) -> event.SingleEvent:
+
+    benchmark_event = event.SingleEvent(None)
+    benchmark_event.event_id = 'benchmark'
+    benchmark_event.away_team = 'Away'
+    benchmark_event.home_team = 'Home'
+
+    start = datetime.datetime(2022, 11, 1, 9, 0, 0)
+    for i in range(snapshots):
+        lines = event.EventLines()
+        lines.last_updated = (start + datetime.timedelta(minutes = 5 * i)).strftime('%Y-%m-%d %H:%M:%S')
+        lines.away_team_spread = -3.5 + (i // 50) * 0.5
+        lines.home_team_spread = -lines.away_team_spread
+        lines.away_team_moneyline = -160 + (i // 40) * 5
+        lines.home_team_moneyline = 135 - (i // 40) * 5
+        lines.over_under = 140.5 + (i // 70) * 0.5
+        benchmark_event.add_update(lines)
+
+    benchmark_event.betting_choices.bet_away_spread = True
+
+    return benchmark_event
+
+def time_renderer(
+    renderer,
+    x_data: list,
+    y_data: list,
+    repeat: int) -> float:
+
+    # render once untimed so one-time setup (imports, template) is excluded
+    renderer(x_data, y_data, 'Date/Time', 'Away Spread', 'Away Spread vs. Time', fixed_y = y_data[0])
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        renderer(x_data, y_data, 'Date/Time', 'Away Spread', 'Away Spread vs. Time', fixed_y = y_data[0])
+
+    return (time.perf_counter() - start) / repeat
+
+def time_downsample(
+    x_data: list,
+    y_data: list,
+    repeat: int) -> float:
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        downsample.downsample(x_data, y_data, downsample.DOWNSAMPLE_MAX_POINTS)
+
+    return (time.perf_counter() - start) / repeat
+
+def benchmark_plots(
+    args: argparse.Namespace) -> None:
+
+    benchmark_event = create_benchmark_event(args.snapshots)
+
+    x_data = list(map(lambda x: x.last_updated, benchmark_event.betting_lines))
+    y_data = list(map(lambda x: x.away_team_spread, benchmark_event.betting_lines))
+    # the spec renderer downsamples first, so both renderers are compared on
+    # the same downsampled series; downsampling is measured on its own.
+    x_sampled, y_sampled = downsample.downsample(x_data, y_data, downsample.DOWNSAMPLE_MAX_POINTS)
+    figure_html = benchmark_event.create_plot_figure_html(x_sampled, y_sampled, 'Date/Time', 'Away Spread', 'Away Spread vs. Time', fixed_y = y_data[0])
+    spec_html = benchmark_event.create_plot_html(x_sampled, y_sampled, 'Date/Time', 'Away Spread', 'Away Spread vs. Time', fixed_y = y_data[0])
+    identical = DIV_ID_PATTERN.sub('', figure_html) == DIV_ID_PATTERN.sub('', spec_html)
+
+    figure_time = time_renderer(benchmark_event.create_plot_figure_html, x_sampled, y_sampled, args.repeat)
+    spec_time = time_renderer(benchmark_event.create_plot_html, x_sampled, y_sampled, args.repeat)
+
+    full_figure_time = time_renderer(benchmark_event.create_plot_figure_html, x_data, y_data, args.repeat)
+    downsample_time = time_downsample(x_data, y_data, args.repeat)
+
+    print(f'Renderers on the same {len(x_sampled)}-point series:')
+    print(f'  go.Figure renderer:   {figure_time * 1000:.2f} ms/plot')
+    print(f'  Direct spec renderer: {spec_time * 1000:.2f} ms/plot ({figure_time / spec_time:.1f}x)')
+    print(f'  Identical output:     {identical}')
+    print(f'Downsampling {args.snapshots} snapshots to {len(x_sampled)} points:')
+    print(f'  Downsample:                   {downsample_time * 1000:.2f} ms/plot')
+    print(f'  go.Figure, full series:       {full_figure_time * 1000:.2f} ms/plot')
+    print(f'  go.Figure, downsampled first: {(downsample_time + figure_time) * 1000:.2f} ms/plot ({full_figure_time / (downsample_time + figure_time):.1f}x)')
+
+    return
+
+def parse_fanmatch_soup(
+    html: str,
+    day: str) -> list:
+
+    from bs4 import BeautifulSoup as bs
+
+    # the html.parser tree walk that fanmatch pages used to be parsed with
+    doc = bs(html, 'html.parser')
+    table = doc.find([kenpom.KP_STR_FANMATCH_TABLE_TAG], id = kenpom.KP_STR_FANMATCH_TABLE_ID)
+    if not table:
+        return []
+
+    events = []
+    for row in table.find_all([kenpom.KP_STR_FANMATCH_ROW_TAG]):
+        kenpom_event = kenpom.KenPomEvent()
+        kenpom_event.load_from_row(row)
+        kenpom_event.game_date = day
+        if kenpom_event.home_team and kenpom_event.away_team:
+            events.append(kenpom_event)
+
+    return events
+
+def time_parser(
+    parser,
+    pages: list,
+    repeat: int) -> float:
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            parser(html, '')
+
+    return (time.perf_counter() - start) / (repeat * len(pages))
+
+def benchmark_fanmatch(
+    args: argparse.Namespace) -> None:
+
+    pages = []
+    for filename in args.filenames:
+        with open(filename, 'r') as f:
+            pages.append(f.read())
+
+    # last_updated differs between runs, so it is left out of the comparison
+    def to_rows(events: list) -> list:
+        return list(map(lambda e: (e.away_team, e.home_team, e.winning_team, e.score, e.confidence), events))
+
+    soup_events = list(map(lambda html: parse_fanmatch_soup(html, ''), pages))
+    lxml_events = list(map(lambda html: kenpom.parse_fanmatch(html, ''), pages))
+    identical = list(map(to_rows, soup_events)) == list(map(to_rows, lxml_events))
+
+    soup_time = time_parser(parse_fanmatch_soup, pages, args.repeat)
+    lxml_time = time_parser(kenpom.parse_fanmatch, pages, args.repeat)
+
+    print(f'Fanmatch pages: {len(pages)} ({sum(map(len, lxml_events))} games)')
+    print(f'  html.parser tree walk: {soup_time * 1000:.2f} ms/page')
+    print(f'  lxml single pass:      {lxml_time * 1000:.2f} ms/page ({soup_time / lxml_time:.1f}x)')
+    print(f'  Identical output:      {identical}')
+
+    return
+
+def benchmark_imports(
+    args: argparse.Namespace) -> None:
+
+    timings = []
+    loaded = set()
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_CHECK_SCRIPT],
+            cwd = path.dirname(path.abspath(__file__)),
+            capture_output = True,
+            text = True,
+            check = True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['elapsed'])
+        loaded.update(set(result['modules']) & set(HEAVY_MODULES))
+
+    median = statistics.median(timings) * 1000
+    print(f'import dk: {median:.1f} ms median of {args.runs} runs (budget {args.budget} ms)')
+    print(f'Heavy modules imported: {", ".join(sorted(loaded)) if loaded else "none"}')
+
+    if median > args.budget or loaded:
+        print('FAILED: importing dk is over budget or pulls in heavy modules')
+        exit(1)
+
+    return
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description =
+        'Micro-benchmarks for the rendering and parsing hot paths.')
+
+    subparsers = parser.add_subparsers(dest = 'benchmark', required = True)
+
+    plots_parser = subparsers.add_parser(
+        'plots',
+        help = 'Compare the go.Figure and direct spec plot renderers')
+    plots_parser.add_argument(
+        '--snapshots',
+        dest = 'snapshots',
+        type = int,
+        default = BENCHMARK_DEFAULT_SNAPSHOTS,
+        help = 'Number of line snapshots per plot')
+    plots_parser.add_argument(
+        '--repeat',
+        dest = 'repeat',
+        type = int,
+        default = BENCHMARK_DEFAULT_REPEAT,
+        help = 'Number of timed renders')
+    plots_parser.set_defaults(run = benchmark_plots)
+
+    fanmatch_parser = subparsers.add_parser(
+        'fanmatch',
+        help = 'Compare the html.parser and lxml fanmatch parsers on archived pages')
+    fanmatch_parser.add_argument(
+        'filenames',
+        nargs = '*',
+        default = [BENCHMARK_FANMATCH_PAGE],
+        help = 'Saved fanmatch.php pages (defaults to the page in fixtures/)')
+    fanmatch_parser.add_argument(
+        '--repeat',
+        dest = 'repeat',
+        type = int,
+        default = BENCHMARK_DEFAULT_REPEAT,
+        help = 'Number of timed parses of every page')
+    fanmatch_parser.set_defaults(run = benchmark_fanmatch)
+
+    imports_parser = subparsers.add_parser(
+        'imports',
+        help = 'Check that importing dk.py stays under budget and lazy')
+    imports_parser.add_argument(
+        '--budget',
+        dest = 'budget',
+        type = float,
+        default = BENCHMARK_IMPORT_BUDGET_MS,
+        help = 'Largest acceptable median import time in ms')
+    imports_parser.add_argument(
+        '--runs',
+        dest = 'runs',
+        type = int,
+        default = BENCHMARK_IMPORT_RUNS,
+        help = 'Number of fresh interpreters timed')
+    imports_parser.set_defaults(run = benchmark_imports)
+
+    try:
+        args = parser.parse_args()
+    except Exception as e:
+        print(f'An error occurred: {str(e)}')
+        exit(1)
+
+    args.run(args)
+    exit(0)
@@ -0,0 +1,200 @@
+#!/usr/bin/python3 -u
+
+import argparse
+import datetime
+from typing import List
+
+import numpy as np
+
+import backtest
+import event
+import kelly
+import persistence
+
+# choice -> (line, odds, opposing line, sign). the sign turns "placed minus
+# closing" into points gained on the close. only moneylines name the other
+# side's line, which is used to take the vig out of the closing price.
+CLV_BETS = {
+    'bet_away_spread': ('away_team_spread', 'away_team_odds', None, 1),
+    'bet_home_spread': ('home_team_spread', 'home_team_odds', None, 1),
+    'bet_over': ('over_under', 'over_odds', None, -1),
+    'bet_under': ('over_under', 'under_odds', None, 1),
+    'bet_away_moneyline': ('away_team_moneyline', 'away_team_moneyline', 'home_team_moneyline', 1),
+    'bet_home_moneyline': ('home_team_moneyline', 'home_team_moneyline', 'away_team_moneyline', 1)
+}
+
+def to_number(
+    value) -> float:
+
+    return float(value) if isinstance(value, (int, float)) else np.nan
+
+def find_closed_events(
+    events: List[event.SingleEvent],
+    today: str) -> List[event.SingleEvent]:
+
+    # stored events carry no in-progress flag, so an event counts as closed
+    # once it has an outcome or its lines stopped updating before today
+    return list(filter(
+        lambda e: e.betting_lines and (e.outcome or e.betting_lines[-1].last_updated[0:10] < today),
+        events))
+
+def create_clv_entries(
+    events: List[event.SingleEvent]) -> List[dict]:
+
+    # gather every ticked bet first, then compute all of them at once
+    entries = []
+    placed = []
+    closing = []
+    for closed_event in events:
+        if not closed_event.betting_lines:
+            continue
+
+        choices = closed_event.betting_choices
+        closing_lines = closed_event.betting_lines[-1].create_placed_dict()
+        for choice in event.BettingChoices.CHOICES:
+            if getattr(choices, choice) != True:
+                continue
+
+            # bets ticked before placed lines were recorded are assumed to
+            # have been placed at the opening line, as the reports draw them
+            placed_lines = choices.placed[choice] if choice in choices.placed else closed_event.betting_lines[0].create_placed_dict()
+
+            entries.append({
+                'event_id': closed_event.event_id,
+                'bet': choice,
+                'away_team': closed_event.away_team,
+                'home_team': closed_event.home_team,
+                'game_date': closed_event.game_date,
+                'placed_at': placed_lines['last_updated'],
+                'closing_at': closing_lines['last_updated']
+            })
+            placed.append(placed_lines)
+            closing.append(closing_lines)
+
+    if not entries:
+        return []
+
+    bets = list(map(lambda e: CLV_BETS[e['bet']], entries))
+    placed_line = np.array(list(map(lambda i: to_number(placed[i][bets[i][0]]), range(len(bets)))))
+    closing_line = np.array(list(map(lambda i: to_number(closing[i][bets[i][0]]), range(len(bets)))))
+    placed_odds = np.array(list(map(lambda i: to_number(placed[i][bets[i][1]]), range(len(bets)))))
+    closing_odds = np.array(list(map(lambda i: to_number(closing[i][bets[i][1]]), range(len(bets)))))
+    closing_opposing = np.array(list(map(lambda i: to_number(closing[i][bets[i][2]]) if bets[i][2] else np.nan, range(len(bets)))))
+    sign = np.array(list(map(lambda b: b[3], bets)))
+    is_moneyline = np.array(list(map(lambda b: b[2] is not None, bets)))
+
+    # spreads and totals gain points on the close; moneylines gain expected
+    # value, pricing the placed odds at the closing no-vig probability
+    clv_points = np.where(is_moneyline, np.nan, sign * (placed_line - closing_line))
+
+    closing_probability = kelly.no_vig_probability(
+        kelly.implied_probability(kelly.american_to_decimal(np.nan_to_num(closing_line))),
+        kelly.implied_probability(kelly.american_to_decimal(np.nan_to_num(closing_opposing))))[:, kelly.AWAY]
+    clv_expected_value = np.where(
+        is_moneyline,
+        closing_probability * kelly.american_to_decimal(np.nan_to_num(placed_line)) - 1,
+        np.nan)
+
+    columns = {
+        'placed_line': placed_line,
+        'placed_odds': placed_odds,
+        'closing_line': closing_line,
+        'closing_odds': closing_odds,
+        'clv_points': clv_points,
+        'clv_expected_value': clv_expected_value
+    }
+    for name, values in columns.items():
+        for entry, value in zip(entries, values.tolist()):
+            entry[name] = None if np.isnan(value) else round(value, 4)
+
+    return entries
+
+def update_clv_ledger(
+    database,
+    events: List[event.SingleEvent]) -> int:
+
+    if database is None:
+        return 0
+
+    entries = create_clv_entries(events)
+    database.upsert_clv_entries(entries)
+
+    return len(entries)
+
+def print_ledger(
+    entries: List[dict]) -> None:
+
+    for bet in CLV_BETS:
+        bet_entries = list(filter(lambda e: e['bet'] == bet, entries))
+        if not bet_entries:
+            continue
+
+        key = 'clv_expected_value' if CLV_BETS[bet][2] else 'clv_points'
+        values = np.array(list(map(lambda e: e[key] if e[key] is not None else np.nan, bet_entries)), dtype = float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            continue
+
+        unit = '%' if key == 'clv_expected_value' else ' pts'
+        scale = 100 if key == 'clv_expected_value' else 1
+        print(f'{bet.ljust(20)} {len(values):5d} bets  mean {values.mean() * scale:+7.2f}{unit}  beat the close {(values > 0).mean() * 100:6.2f}%')
+
+    return
+
+def main(
+    args: argparse.Namespace) -> None:
+
+    client = persistence.create_client(args.backend, host = args.host, directory = args.directory)
+    database = client.get_database(args.database)
+
+    if args.command == 'rebuild':
+        events = find_closed_events(
+            event.load_all_events_from_database(database),
+            str(datetime.date.today()))
+        count = update_clv_ledger(database, events)
+        print(f'Recorded {count} bets from {len(events)} closed events')
+
+    print_ledger(database.find_clv_entries())
+
+    return
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description =
+        'Closing line value of every placed bet, measured against the frozen \
+        closing lines.')
+
+    parser.add_argument(
+        'command',
+        choices = ['rebuild', 'show'],
+        help = 'Rebuild the ledger from the whole history, or show it')
+    parser.add_argument(
+        '--backend',
+        dest = 'backend',
+        choices = [persistence.DB_BACKEND_MONGO, persistence.DB_BACKEND_SQLITE],
+        default = backtest.BACKTEST_DEFAULT_BACKEND,
+        help = 'Database backend holding the line history')
+    parser.add_argument(
+        '--database',
+        dest = 'database',
+        required = True,
+        help = 'Database to load (e.g., cfb, ncaam)')
+    parser.add_argument(
+        '--host',
+        dest = 'host',
+        default = backtest.BACKTEST_DEFAULT_HOST,
+        help = 'MongoDB host')
+    parser.add_argument(
+        '--directory',
+        dest = 'directory',
+        default = backtest.BACKTEST_DEFAULT_DIRECTORY,
+        help = 'SQLite database directory')
+
+    try:
+        args = parser.parse_args()
+    except Exception as e:
+        print(f'An error occurred: {str(e)}')
+        exit(1)
+
+    main(args)
+    exit(0)
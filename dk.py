@@ -1,17 +1,30 @@
 #!/usr/bin/python3 -u
 
 import argparse
-from bs4 import BeautifulSoup as bs
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-from pymongo import MongoClient
-import requests
-from typing import List
+from typing import List, TYPE_CHECKING
 
 import event
-import google_sheets_utils as gsu
 import kenpom
+import persistence
+import report
+import steam
+
+# bs4, requests and the google api client are only imported once a group is
+# actually loaded or synced, which keeps startup fast for one-shot runs.
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup as bs
 
 DK_USE_DATABASE = False
+DK_DATABASE_BACKEND = persistence.DB_BACKEND_SQLITE
+DK_DATABASE_HOST = 'localhost'
+DK_SQLITE_DIRECTORY = './data'
+
+DK_REPORT_DIRECTORY = report.REPORT_DEFAULT_DIRECTORY
+
+# maximum fraction of the bankroll staked across a slate by portfolio sizing
+DK_PORTFOLIO_CAP = 0.25
 
 DK_STR_BASE_URL = 'https://sportsbook.draftkings.com'
 DK_STR_EVENTS_URL = f'{DK_STR_BASE_URL}/event'
@@ -73,6 +86,66 @@ NCAAM_SHEET_INDEX = 1
 
 REQUEST_TIMEOUT = 5
 
+# kenpom predictions for today and this many following days are fetched in
+# the background while the draftkings page loads
+DK_KENPOM_PREFETCH_DAYS = 2
+
+# format of the game dates shown on the daily cards
+DK_GAME_DATE_FORMAT = '%a %b %d'
+
+def to_game_date(
+    card_date: str) -> str:
+
+    # the daily cards are labelled 'Today', 'Tomorrow' or a date with an
+    # ordinal suffix, e.g. 'Sat Nov 15th'
+    game_date = card_date.strip()
+    if game_date.lower() == 'today':
+        # check if it's past 7 pm eastern. if so, 'today' is really 'tomorrow'
+        if datetime.datetime.now().time() > datetime.time(19, 0, 0):
+            game_date = (datetime.datetime.today() + datetime.timedelta(days = 1)).strftime('%a %b %-d')
+        else:
+            # probably need a similar check here, too
+            game_date = datetime.date.today().strftime('%a %b %-d')
+    elif game_date.lower() == 'tomorrow':
+        game_date = (datetime.date.today() + datetime.timedelta(days = 1)).strftime('%a %b %-d')
+    elif game_date:
+        game_date = game_date[0:-2]
+
+    return game_date
+
+def to_iso_date(
+    game_date: str) -> str:
+
+    # the cards carry no year, so take the year around today whose calendar
+    # puts the date on the weekday shown; ties go to the nearest date.
+    today = datetime.date.today()
+    candidates = []
+    for year in (today.year - 1, today.year, today.year + 1):
+        try:
+            parsed = datetime.datetime.strptime(f'{game_date} {year}', f'{DK_GAME_DATE_FORMAT} %Y').date()
+        except ValueError:
+            continue
+
+        # strptime does not check the weekday against the date
+        if parsed.strftime('%a') == game_date.split(' ', 1)[0]:
+            candidates.append(parsed)
+
+    if not candidates:
+        return ''
+
+    return str(min(candidates, key = lambda d: abs((d - today).days)))
+
+def fetch_kenpom(
+    days: List[str],
+    cache: kenpom.KenPomCache) -> tuple:
+
+    # both are written to the same cache file, so they are fetched one after
+    # the other on the background thread
+    events_by_date = kenpom.get_kenpom_events_by_date(days, cache = cache)
+    team_ratings = kenpom.get_kenpom_ratings(cache = cache)
+
+    return events_by_date, team_ratings
+
 class DraftKingsSingleEvent(event.SingleEvent):
     '''A single event (game) including basic gambling information.'''
 
@@ -88,7 +161,8 @@ class DraftKingsSingleEvent(event.SingleEvent):
         'betting_choices',
         'outcome',
         'sheet_name',
-        'database'
+        'database',
+        'listeners'
     ]
 
     def __init__(
@@ -102,6 +176,7 @@ class DraftKingsSingleEvent(event.SingleEvent):
         self.betting_choices = event.BettingChoices()
         self.outcome = None
         self.database = database
+        self.listeners = []
 
         return
 
@@ -112,7 +187,7 @@ class DraftKingsSingleEvent(event.SingleEvent):
 
     def update_from_rows(
         self,
-        rows: List[bs],
+        rows: List['bs'],
         **kwargs) -> None:
 
         # we do not want to update in-progress events. this allows us to
@@ -199,18 +274,7 @@ class DraftKingsSingleEvent(event.SingleEvent):
         # fix this properly, but it seems to work with this approach for
         # now.
         if not self.game_date:
-            self.game_date = kwargs['date'].strip() if 'date' in kwargs else ''
-            if self.game_date.lower() == 'today':
-                # check if it's past 7 pm eastern. if so, 'today' is really 'tomorrow'
-                if datetime.datetime.now().time() > datetime.time(19, 0, 0):
-                    self.game_date = (datetime.datetime.today() + datetime.timedelta(days = 1)).strftime('%a %b %-d')
-                else:
-                    # probably need a similar check here, too
-                    self.game_date = datetime.date.today().strftime('%a %b %-d')
-            elif self.game_date.lower() == 'tomorrow':
-                self.game_date = (datetime.date.today() + datetime.timedelta(days = 1)).strftime('%a %b %-d')
-            elif self.game_date:
-                self.game_date = self.game_date[0:-2]
+            self.game_date = to_game_date(kwargs['date'] if 'date' in kwargs else '')
 
         if not self.game_time:
             if 'time' in kwargs:
@@ -237,7 +301,10 @@ class DraftKingsEventGroup:
         'include_kenpom',
         'names_to_update',
         'database_name',
-        'database'
+        'database',
+        'portfolio_stakes',
+        'steam_detector',
+        'kenpom_cache'
     ]
 
     def __init__(
@@ -260,12 +327,19 @@ class DraftKingsEventGroup:
         self.names_to_update = []
 
 
-        self.database_name = ''
+        self.database_name = database_name
         self.database = None
-        if DK_USE_DATABASE in globals() and DK_USE_DATABASE:
-            self.database_name = database_name
+        if database_client is not None:
             self.database = database_client.get_database(database_name)
 
+        # joint stakes per event, set when portfolio sizing is requested
+        self.portfolio_stakes = None
+
+        # listener that is handed every snapshot as it is added to an event
+        self.steam_detector = None
+
+        # parsed kenpom predictions shared between polls
+        self.kenpom_cache = None
 
         return
 
@@ -276,9 +350,24 @@ class DraftKingsEventGroup:
         if not self.url:
             return False
 
-        kenpom_events = kenpom.get_kenpom_events() if self.include_kenpom else []
+        from bs4 import BeautifulSoup as bs
+        import requests
+
         self.names_to_update = []
 
+        # kenpom is fetched on a background thread for the dates the slate
+        # usually covers, overlapping the draftkings request and parse; the
+        # result is only waited on when the games are matched.
+        kenpom_future = None
+        if self.include_kenpom:
+            today = datetime.date.today()
+            prefetch_days = list(map(lambda d: str(today + datetime.timedelta(days = d)), range(DK_KENPOM_PREFETCH_DAYS + 1)))
+            executor = ThreadPoolExecutor(max_workers = 1)
+            kenpom_future = executor.submit(
+                fetch_kenpom,
+                prefetch_days,
+                self.kenpom_cache)
+
         cookies = kwargs['cookies'] if 'cookies' in kwargs else {}
         headers = kwargs['headers'] if 'headers' in kwargs else {}
         response = requests.get(self.url, cookies = cookies, headers = headers, params = self.url_params, timeout = REQUEST_TIMEOUT)
@@ -287,7 +376,7 @@ class DraftKingsEventGroup:
         doc = bs(response.text, 'html.parser')
         daily_cards = doc.find_all([DK_STR_DAILY_CARD_TAG], class_ = DK_STR_DAILY_CARD_CLASS)
 
-        self.events = []
+        rows_to_load = []
         for day in daily_cards:
             date = day.find([DK_STR_DAILY_CARD_DATE_TAG], class_ = DK_STR_DAILY_CARD_DATE_CLASS)
             if not date:
@@ -313,53 +402,148 @@ class DraftKingsEventGroup:
                         in_progress = True
 
                 event_id = day_rows[row].find([DK_STR_SINGLE_GAME_EVENT_LINK_TAG], class_ = DK_STR_SINGLE_GAME_EVENT_LINK_CLASS).attrs['href'].split('/', -1)[-1]
+                rows_to_load.append((date, [day_rows[row], day_rows[row + 1]], start_time, in_progress, event_id))
+
+        # slate dates outside the prefetched ones are queued on the same
+        # thread, so they share its session and cache and still overlap the
+        # database lookup and the parse of every event.
+        missing_future = None
+        if kenpom_future is not None:
+            slate_days = set(filter(None, map(lambda r: to_iso_date(to_game_date(r[0])), rows_to_load)))
+            missing_days = sorted(slate_days - set(prefetch_days))
+            if missing_days:
+                missing_future = executor.submit(
+                    kenpom.get_kenpom_events_by_date,
+                    missing_days,
+                    cache = self.kenpom_cache)
+            executor.shutdown(wait = False)
+
+        # hydrate every event on the slate with a single batched lookup
+        # rather than one query per event.
+        documents = {}
+        if self.database is not None:
+            documents = self.database.find_events(list(map(lambda r: r[4], rows_to_load)))
 
-                new_event = DraftKingsSingleEvent(self.database)
-                _ = event.populate_event_from_database(
-                    self.database,
-                    new_event,
-                    event_id)
-
-                new_event.update_from_rows([day_rows[row], day_rows[row + 1]], date = date, time = start_time, event_id = event_id, in_progress = in_progress)
-                new_event.sheet_name = self.sheet_name
-
-                skip = False
-                if not new_event.game_date:
-                    skip = True
-
-                # jmd: temporary hack: only accept events that have a valid moneyline
-                if self.skip_missing_moneyline:
-                    if new_event.betting_lines:
-                        if new_event.betting_lines[0].home_team_moneyline == 0 and new_event.betting_lines[0].away_team_moneyline == 0:
-                            skip = True
-
-                if not skip:
-                    self.events.append(new_event)
-
-                    for kenpom_event in kenpom_events:
-                        if kenpom_event.contains_team(new_event.home_team) and kenpom_event.contains_team(new_event.away_team):
-                            new_event.betting_lines[-1].kenpom_event = kenpom_event if new_event.betting_lines else None
-                        elif kenpom_event.contains_team(new_event.home_team) or kenpom_event.contains_team(new_event.away_team):
-                            if new_event.home_team != kenpom_event.home_team:
-                                self.names_to_update.append((kenpom_event.home_team, new_event.home_team))
-                            if new_event.away_team != kenpom_event.away_team:
-                                self.names_to_update.append((kenpom_event.away_team, new_event.away_team))
-
-                    new_event.update_database()
-                else:
-                    game_time_string = f' ({new_event.game_date}, {new_event.game_time})' if (new_event.game_date and new_event.game_time) else ''
-                    event_url = f' - {new_event.create_event_url()}'
-                    print(f'Skipping incomplete event: {new_event.away_team} @ {new_event.home_team}{game_time_string}{event_url}')
-                    continue
+        self.events = []
+        updated_events = []
+        for date, rows, start_time, in_progress, event_id in rows_to_load:
+            new_event = DraftKingsSingleEvent(self.database)
+            if self.steam_detector is not None:
+                new_event.add_listener(self.steam_detector)
+
+            _ = event.populate_event_from_document(
+                new_event,
+                event_id,
+                documents[event_id] if event_id in documents else None)
+
+            line_count = len(new_event.betting_lines)
+            new_event.update_from_rows(rows, date = date, time = start_time, event_id = event_id, in_progress = in_progress)
+            new_event.sheet_name = self.sheet_name
+
+            skip = False
+            if not new_event.game_date:
+                skip = True
+
+            # jmd: temporary hack: only accept events that have a valid moneyline
+            if self.skip_missing_moneyline:
+                if new_event.betting_lines:
+                    if new_event.betting_lines[0].home_team_moneyline == 0 and new_event.betting_lines[0].away_team_moneyline == 0:
+                        skip = True
+
+            if not skip:
+                self.events.append(new_event)
+
+                # in-progress events are frozen and gain no new lines, so
+                # there is nothing to append for them.
+                if len(new_event.betting_lines) > line_count:
+                    updated_events.append(new_event)
+            else:
+                game_time_string = f' ({new_event.game_date}, {new_event.game_time})' if (new_event.game_date and new_event.game_time) else ''
+                event_url = f' - {new_event.create_event_url()}'
+                print(f'Skipping incomplete event: {new_event.away_team} @ {new_event.home_team}{game_time_string}{event_url}')
+                continue
+
+        if kenpom_future is not None:
+            events_by_date, team_ratings = kenpom_future.result()
+            if missing_future is not None:
+                events_by_date.update(missing_future.result())
+            self.match_kenpom_events(events_by_date, team_ratings)
+
+        event.update_events_in_database(
+            self.database,
+            updated_events)
 
         self.last_updated = f'{datetime.date.today()} {datetime.datetime.now().strftime("%H:%M:%S")}'
         return True
 
+    def match_kenpom_events(
+        self,
+        events_by_date: dict,
+        team_ratings: list) -> None:
+
+        # the slate spans several daily cards, whose dates were all fetched
+        # from fanmatch by now; an event that kept the date stored with it
+        # from an earlier run may fall outside them, so those dates are
+        # fetched here. a game is only matched against the predictions for
+        # its own date.
+        game_dates = dict(map(lambda e: (e.event_id, to_iso_date(e.game_date)), self.events))
+        missing = list(filter(lambda d: d and d not in events_by_date, set(game_dates.values())))
+
+        events_by_date = dict(events_by_date)
+        if missing:
+            events_by_date.update(kenpom.get_kenpom_events_by_date(missing, cache = self.kenpom_cache))
+
+        index = kenpom.KenPomIndex(events_by_date)
+
+        unmatched = []
+        for slate_event in self.events:
+            game_date = game_dates[slate_event.event_id]
+            home = index.find(game_date, slate_event.home_team)
+            away = index.find(game_date, slate_event.away_team)
+
+            if home is not None and home is away:
+                if slate_event.betting_lines:
+                    slate_event.betting_lines[-1].kenpom_event = home
+                continue
+
+            if home is None and away is None:
+                unmatched.append(slate_event)
+                continue
+
+            # one team matched a prediction on that date but the other did
+            # not, so the names differ between the two sites
+            for kenpom_event in filter(None, (home, away) if home is not away else (home,)):
+                if slate_event.home_team != kenpom_event.home_team:
+                    self.names_to_update.append((kenpom_event.home_team, slate_event.home_team))
+                if slate_event.away_team != kenpom_event.away_team:
+                    self.names_to_update.append((kenpom_event.away_team, slate_event.away_team))
+
+        # games fanmatch does not list are predicted from the ratings table,
+        # all in one batch; numpy is only imported when there are any
+        unmatched = list(filter(lambda e: e.betting_lines and game_dates[e.event_id], unmatched))
+        if unmatched and team_ratings:
+            import ratings
+
+            predictions = ratings.predict_games(
+                ratings.TeamRatings(team_ratings),
+                list(map(lambda e: (game_dates[e.event_id], e.away_team, e.home_team), unmatched)))
+
+            for slate_event, prediction in zip(unmatched, predictions):
+                if prediction is not None:
+                    slate_event.betting_lines[-1].kenpom_event = prediction
+
+        return
+
 
 def main(
     args: argparse.Namespace) -> None:
 
-    db_client = MongoClient('localhost')
+    # only connect to a database when one was requested; the sqlite backend
+    # needs no server and runs entirely from local files.
+    db_client = persistence.create_client(
+        args.database,
+        host = DK_DATABASE_HOST,
+        directory = DK_SQLITE_DIRECTORY)
 
     event_groups = []
     if args.cfb:
@@ -393,6 +577,8 @@ def main(
         print('ERROR: At least one event group (CFB, NCAAM, etc.) must be specified; exiting.')
         return
 
+    import google_sheets_utils as gsu
+
     service = gsu.get_spreadsheet_service()
     service._http.timeout = REQUEST_TIMEOUT
 
@@ -405,7 +591,16 @@ def main(
         "User-Agent": "Mozilla/5.0 (X11; CrOS x86_64 12871.102.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.141 Safari/537.36"
     }
 
+    # one detector watches every group; its rolling state is keyed by event
+    steam_detector = steam.SteamDetector(args.steam_log, args.steam_window) if args.steam_log else None
+
+    kenpom_cache = kenpom.KenPomCache(kenpom.KP_CACHE_FILE, args.kenpom_ttl)
+    if args.kenpom_refresh:
+        kenpom_cache.invalidate()
+
     for event_group in event_groups:
+        event_group.steam_detector = steam_detector
+        event_group.kenpom_cache = kenpom_cache
         event_group.load_from_url(cookies = cookies, headers = headers)
 
         if event_group.names_to_update:
@@ -415,6 +610,18 @@ def main(
 
         print(f'  Retrieved data for {len(event_group.events)} qualifying events')
 
+        if args.portfolio and event_group.include_kenpom:
+            # numpy is only imported when portfolio sizing is requested
+            import portfolio
+
+            event_group.portfolio_stakes = portfolio.optimize_event_group(
+                event_group.events,
+                args.portfolio_cap)
+
+            staked = list(filter(lambda s: s[0] > 0 or s[1] > 0, event_group.portfolio_stakes.values()))
+            total = sum(map(lambda s: s[0] + s[1], staked))
+            print(f'  Portfolio: {len(staked)} bets staking {total * 100:.2f}% of the bankroll (cap {args.portfolio_cap * 100:.0f}%)')
+
     if args.new_spreadsheet:
         gsu.create_new_spreadsheet_from_events(
             'KEEP GAMING',
@@ -424,6 +631,30 @@ def main(
             args.existing_spreadsheet,
             event_groups)
 
+    # bets on events that have started are measured against their frozen
+    # closing lines and recorded in the ledger
+    for event_group in event_groups:
+        if event_group.database is not None:
+            import clv
+
+            clv.update_clv_ledger(
+                event_group.database,
+                list(filter(lambda e: e.in_progress, event_group.events)))
+
+    # html reports are rendered as a separate stage once the sheet is in
+    # sync, so they never hold up the sheets api calls.
+    if args.write_reports:
+        report.write_event_reports(
+            event_groups,
+            args.report_directory,
+            args.report_workers)
+
+    # the dashboard reads every event from a single columnar export
+    report.write_slate_data(
+        event_groups,
+        args.report_directory,
+        args.dashboard)
+
     return
 
 if __name__ == '__main__':
@@ -460,6 +691,87 @@ if __name__ == '__main__':
         help = 'Request NCAAM data'
     )
 
+    parser.add_argument(
+        '--database',
+        dest = 'database',
+        choices = persistence.DB_BACKENDS,
+        default = DK_DATABASE_BACKEND if DK_USE_DATABASE else persistence.DB_BACKEND_NONE,
+        help = 'Database backend used to record line history'
+    )
+
+    parser.add_argument(
+        '--no-reports',
+        action = 'store_false',
+        dest = 'write_reports',
+        default = True,
+        help = 'Skip writing the per-event HTML reports'
+    )
+    parser.add_argument(
+        '--report-dir',
+        dest = 'report_directory',
+        default = DK_REPORT_DIRECTORY,
+        help = 'Directory the per-event HTML reports are written to'
+    )
+    parser.add_argument(
+        '--report-workers',
+        dest = 'report_workers',
+        type = int,
+        default = None,
+        help = 'Number of processes used to render reports (default: one per CPU)'
+    )
+
+    parser.add_argument(
+        '--dashboard',
+        dest = 'dashboard',
+        choices = report.SLATE_MODES,
+        default = report.SLATE_MODE_FULL,
+        help = 'Export the slate for the dashboard; append only adds new snapshots (for watch runs)'
+    )
+
+    parser.add_argument(
+        '--portfolio',
+        action = 'store_true',
+        dest = 'portfolio',
+        default = False,
+        help = 'Size all bets jointly and write the stakes to the Kelly (Latest) column'
+    )
+    parser.add_argument(
+        '--portfolio-cap',
+        dest = 'portfolio_cap',
+        type = float,
+        default = DK_PORTFOLIO_CAP,
+        help = 'Maximum fraction of the bankroll staked across the slate'
+    )
+
+    parser.add_argument(
+        '--steam-log',
+        dest = 'steam_log',
+        default = None,
+        help = 'File sharp line move alerts are appended to; needs --database for the line history moves are measured against'
+    )
+    parser.add_argument(
+        '--steam-window',
+        dest = 'steam_window',
+        type = int,
+        default = steam.STEAM_DEFAULT_WINDOW_MINUTES,
+        help = 'Minutes within which a line move counts as steam'
+    )
+
+    parser.add_argument(
+        '--kenpom-ttl',
+        dest = 'kenpom_ttl',
+        type = int,
+        default = kenpom.KP_CACHE_TTL,
+        help = 'Seconds cached KenPom predictions are reused for'
+    )
+    parser.add_argument(
+        '--kenpom-refresh',
+        action = 'store_true',
+        dest = 'kenpom_refresh',
+        default = False,
+        help = 'Discard cached KenPom predictions and fetch them again'
+    )
+
     try:
         args = parser.parse_args()
     except Exception as e:
@@ -0,0 +1,122 @@
+import datetime
+from typing import List, Tuple
+
+# maximum number of points drawn (or exported) for a single series
+DOWNSAMPLE_MAX_POINTS = 500
+
+DOWNSAMPLE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def to_number(
+    value) -> float:
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def create_x_positions(
+    x_data: List) -> List[float]:
+
+    # snapshots are timestamped strings; fall back to the snapshot index if
+    # any of them cannot be parsed so the spacing is at least monotonic.
+    positions = []
+    for x in x_data:
+        try:
+            positions.append(datetime.datetime.strptime(x, DOWNSAMPLE_TIME_FORMAT).timestamp())
+        except (TypeError, ValueError):
+            return list(map(float, range(len(x_data))))
+
+    return positions
+
+def find_change_points(
+    y_data: List) -> List[int]:
+
+    # lines are drawn as steps, so only the first snapshot of each run of
+    # identical values matters, plus the latest snapshot to extend the step.
+    if not y_data:
+        return []
+
+    indices = [0]
+    for i in range(1, len(y_data)):
+        if y_data[i] != y_data[i - 1]:
+            indices.append(i)
+
+    if indices[-1] != len(y_data) - 1:
+        indices.append(len(y_data) - 1)
+
+    return indices
+
+def largest_triangle_three_buckets(
+    x_positions: List[float],
+    y_data: List,
+    indices: List[int],
+    max_points: int) -> List[int]:
+
+    if len(indices) <= max_points or max_points < 3:
+        return indices
+
+    # the first and last points are always kept; the rest are split into
+    # equal buckets and each bucket keeps the point forming the largest
+    # triangle with the previously kept point and the next bucket's average.
+    selected = [indices[0]]
+    bucket_size = (len(indices) - 2) / (max_points - 2)
+
+    previous = indices[0]
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+
+        next_start = end
+        next_end = min(int((bucket + 2) * bucket_size) + 1, len(indices))
+        next_bucket = indices[next_start:next_end] if next_start < next_end else [indices[-1]]
+        average_x = sum(map(lambda i: x_positions[i], next_bucket)) / len(next_bucket)
+        average_y = sum(map(lambda i: to_number(y_data[i]), next_bucket)) / len(next_bucket)
+
+        previous_x = x_positions[previous]
+        previous_y = to_number(y_data[previous])
+
+        best_area = -1
+        best_index = indices[start]
+        for i in indices[start:end]:
+            area = abs(
+                (previous_x - average_x) * (to_number(y_data[i]) - previous_y) -
+                (previous_x - x_positions[i]) * (average_y - previous_y))
+            if area > best_area:
+                best_area = area
+                best_index = i
+
+        selected.append(best_index)
+        previous = best_index
+
+    selected.append(indices[-1])
+
+    return selected
+
+def downsample_indices(
+    x_data: List,
+    y_data: List,
+    max_points: int) -> List[int]:
+
+    # a series that already fits is kept as it is, so that every snapshot
+    # keeps its marker; only larger ones are collapsed to change points.
+    if len(y_data) <= max_points:
+        return list(range(len(y_data)))
+
+    indices = find_change_points(y_data)
+    if len(indices) <= max_points:
+        return indices
+
+    return largest_triangle_three_buckets(
+        create_x_positions(x_data),
+        y_data,
+        indices,
+        max_points)
+
+def downsample(
+    x_data: List,
+    y_data: List,
+    max_points: int) -> Tuple[List, List]:
+
+    indices = downsample_indices(x_data, y_data, max_points)
+
+    return list(map(lambda i: x_data[i], indices)), list(map(lambda i: y_data[i], indices))
@@ -1,14 +1,39 @@
-import plotly.express as px
-import plotly.graph_objects as go
-from pymongo import database, MongoClient
+from os import path
 from typing import List
 
+import downsample
 from kenpom import KenPomEvent
+import plot_spec
+
+HTML_TEMPLATE_FILE = path.join(path.dirname(path.abspath(__file__)), 'template.html')
+
+# the report template is read from disk once per process
+HTML_TEMPLATE_CACHE = {}
+
+def load_html_template() -> str:
+
+    if HTML_TEMPLATE_FILE not in HTML_TEMPLATE_CACHE:
+        with open(HTML_TEMPLATE_FILE, 'r') as f:
+            HTML_TEMPLATE_CACHE[HTML_TEMPLATE_FILE] = '\n'.join(f.readlines())
+        f.close()
+
+    return HTML_TEMPLATE_CACHE[HTML_TEMPLATE_FILE]
 
 class BettingChoices:
     '''A grouping of betting choices for a single event.'''
 
     __slots__ = [
+        'bet_away_spread',
+        'bet_away_moneyline',
+        'bet_home_spread',
+        'bet_home_moneyline',
+        'bet_over',
+        'bet_under',
+        'placed',
+        'dirty'
+    ]
+
+    CHOICES = [
         'bet_away_spread',
         'bet_away_moneyline',
         'bet_home_spread',
@@ -22,8 +47,34 @@ class BettingChoices:
         for slot in self.__slots__:
             self.__setattr__(slot, False)
 
+        # the lines on offer when each choice was ticked, keyed by choice
+        self.placed = {}
+
         return
 
+    def update_from_choices(
+        self,
+        choices: 'BettingChoices',
+        **kwargs) -> bool:
+
+        # the latest lines, recorded as the placed line for newly ticked choices
+        lines = kwargs['lines'] if 'lines' in kwargs else None
+
+        # only flag the choices as dirty if something actually changed, so
+        # that unchanged choices are never written back to the database.
+        for choice in self.CHOICES:
+            value = getattr(choices, choice)
+            if getattr(self, choice) != value:
+                self.__setattr__(choice, value)
+                self.dirty = True
+
+                if value and lines:
+                    self.placed[choice] = lines.create_placed_dict()
+                elif choice in self.placed:
+                    del self.placed[choice]
+
+        return self.dirty
+
     def load_from_database(
         self,
         db_entry: dict):
@@ -34,6 +85,10 @@ class BettingChoices:
         self.bet_home_moneyline = db_entry['bet_home_moneyline'] if 'bet_home_moneyline' in db_entry else ''
         self.bet_over = db_entry['bet_over'] if 'bet_over' in db_entry else ''
         self.bet_under = db_entry['bet_under'] if 'bet_under' in db_entry else ''
+        self.placed = db_entry['placed'] if 'placed' in db_entry else {}
+
+        # freshly loaded choices match the database by definition
+        self.dirty = False
 
         return
 
@@ -49,6 +104,9 @@ class BettingChoices:
             'bet_under': self.bet_under
         }
 
+        if self.placed:
+            d['placed'] = self.placed
+
         return d
 
     def print(
@@ -107,6 +165,8 @@ class EventLines:
         self.over_odds = db_entry['over_odds'] if 'over_odds' in db_entry else ''
         self.under_odds = db_entry['under_odds'] if 'under_odds' in db_entry else ''
 
+        # the store resolves kenpom_id references into the prediction they
+        # point at; older snapshots embed the prediction itself
         if 'kenpom_event' in db_entry:
             self.kenpom_event = KenPomEvent()
             self.kenpom_event.load_from_database(db_entry['kenpom_event'])
@@ -129,8 +189,20 @@ class EventLines:
             'under_odds': self.under_odds
         }
 
+        # the prediction itself is stored once per game, date and content,
+        # and every snapshot only refers to it
         if self.kenpom_event:
-            d['kenpom_event'] = self.kenpom_event.create_mongodb_dict()
+            d['kenpom_id'] = self.kenpom_event.create_id()
+
+        return d
+
+    def create_placed_dict(
+        self) -> dict:
+
+        # the lines a bet was placed at; the kenpom prediction is left out
+        d = self.create_mongodb_dict()
+        if 'kenpom_id' in d:
+            del d['kenpom_id']
 
         return d
 
@@ -142,21 +214,14 @@ class EventLines:
         if not self.kenpom_event:
             return 0
 
-        moneyline = self.home_team_moneyline if is_home_team else self.away_team_moneyline
-        decimal_odds = 0
-        if moneyline >= 0:
-            decimal_odds = (moneyline / 100) + 1
-        else:
-            decimal_odds = (100 / -moneyline) + 1
-
+        # numpy is only imported once kelly values are actually needed
+        import kelly
 
-        b = decimal_odds - 1
+        moneyline = self.home_team_moneyline if is_home_team else self.away_team_moneyline
         p = self.kenpom_event.confidence if self.kenpom_event.winning_team == team else 1 - self.kenpom_event.confidence
-        q = 1 - p
-        k = (b * p - q) / b if b != 0 else 0
+        k = kelly.kelly_fraction(p, kelly.american_to_decimal(kelly.to_float(moneyline)))
 
-        f = '{:.2f}'.format(k)
-        return float(f)
+        return round(float(k), 2)
 
     def print(
         self,
@@ -202,6 +267,56 @@ class EventOutcome:
 
         return
 
+    def load_from_database(
+        self,
+        db_entry: dict):
+
+        self.winning_team = db_entry['winning_team'] if 'winning_team' in db_entry else ''
+        self.winning_team_score = db_entry['winning_team_score'] if 'winning_team_score' in db_entry else ''
+        self.losing_team = db_entry['losing_team'] if 'losing_team' in db_entry else ''
+        self.losing_team_score = db_entry['losing_team_score'] if 'losing_team_score' in db_entry else ''
+
+        return
+
+    def load_from_scores(
+        self,
+        away_team: str,
+        away_team_score: int,
+        home_team: str,
+        home_team_score: int):
+
+        if away_team_score > home_team_score:
+            self.winning_team, self.winning_team_score = away_team, away_team_score
+            self.losing_team, self.losing_team_score = home_team, home_team_score
+        else:
+            self.winning_team, self.winning_team_score = home_team, home_team_score
+            self.losing_team, self.losing_team_score = away_team, away_team_score
+
+        return
+
+    def get_score(
+        self,
+        team: str) -> int:
+
+        if team == self.winning_team:
+            return self.winning_team_score
+        if team == self.losing_team:
+            return self.losing_team_score
+
+        return None
+
+    def create_mongodb_dict(
+        self) -> dict:
+
+        d = {
+            'winning_team': self.winning_team,
+            'winning_team_score': self.winning_team_score,
+            'losing_team': self.losing_team,
+            'losing_team_score': self.losing_team_score
+        }
+
+        return d
+
 
 class SingleEvent:
     '''A single event (game) with betting information.'''
@@ -216,7 +331,8 @@ class SingleEvent:
         'betting_lines',
         'betting_choices',
         'outcome',
-        'database'
+        'database',
+        'listeners'
     ]
 
     def __init__(
@@ -229,6 +345,7 @@ class SingleEvent:
         self.betting_choices = BettingChoices()
         self.outcome = None
         self.database = None
+        self.listeners = []
 
         return
 
@@ -243,6 +360,7 @@ class SingleEvent:
         self.betting_choices = BettingChoices()
         self.outcome = None
         self.database = database
+        self.listeners = []
 
         return
 
@@ -251,13 +369,28 @@ class SingleEvent:
 
         return 'Link not implemented'
 
+    def add_listener(
+        self,
+        listener) -> None:
+
+        self.listeners.append(listener)
+
+        return
+
     def add_update(
         self,
-        update: EventLines) -> None:
+        update: EventLines,
+        **kwargs) -> None:
 
         self.betting_lines.append(update)
         self.last_updated = update.last_updated
 
+        # listeners see every snapshot as it is added; replayed history from
+        # the database is flagged so it only rebuilds their state.
+        replay = kwargs['replay'] if 'replay' in kwargs else False
+        for listener in self.listeners:
+            listener.on_update(self, update, replay)
+
         return
 
     def set_outcome(
@@ -268,34 +401,33 @@ class SingleEvent:
 
         return
 
+    def create_database_document(
+        self) -> dict:
+
+        d = {
+            'event_id': self.event_id,
+            'last_updated': self.last_updated,
+            'game_date': self.game_date,
+            'game_time': self.game_time,
+            'away_team': self.away_team,
+            'home_team': self.home_team,
+            'betting_lines': [],
+            'betting_choices': {},
+            'outcome': {}
+        }
+
+        return d
+
     def create_empty_database_document(
         self) -> bool:
 
         if self.database is None:
             return False
 
-        found_event = self.database.events.find({
-            'event_id': self.event_id
-        })
-
-        try:
-            _ = found_event[0]
-        except:
-            event = {
-                'event_id': self.event_id,
-                'last_updated': self.last_updated,
-                'game_date': self.game_date,
-                'game_time': self.game_time,
-                'away_team': self.away_team,
-                'home_team': self.home_team,
-                'betting_lines': [],
-                'betting_choices': {},
-                'outcome': {}
-            }
-
-            return self.database.events.insert_one(event)
+        # the store only inserts the document if the event is new
+        self.database.create_events([self.create_database_document()])
 
-        return False
+        return True
 
     def append_latest_lines_to_database(
         self) -> None:
@@ -303,22 +435,10 @@ class SingleEvent:
         if self.database is None or not self.betting_lines:
             return
 
-        results = self.database.events.find({'event_id': self.event_id})
-        try:
-            result = results[0]
-        except:
-            return
-
-        self.database.events.update_one(
-            {
-                '_id': result['_id']
-            },
-            {
-                '$push': {
-                    'betting_lines': self.betting_lines[-1].create_mongodb_dict()
-                }
-            }
-        )
+        if self.betting_lines[-1].kenpom_event:
+            kenpom_event = self.betting_lines[-1].kenpom_event
+            self.database.upsert_kenpom_predictions([(kenpom_event.create_id(), kenpom_event.create_mongodb_dict())])
+        self.database.push_betting_lines([(self.event_id, self.betting_lines[-1].create_mongodb_dict())])
 
         return
 
@@ -336,28 +456,25 @@ class SingleEvent:
     def update_betting_choices_in_database(
         self) -> None:
 
-        if self.database is None or not self.betting_choices:
-            return False
-
-        results = self.database.events.find({'event_id': self.event_id})
-        try:
-            result = results[0]
-        except:
-            return False
+        if self.database is None or not self.betting_choices.dirty:
+            return
 
-        self.database.events.update_one(
-            {
-                '_id': result['_id']
-            },
-            {
-                '$set': {
-                    'betting_choices': self.betting_choices.create_mongodb_dict()
-                }
-            }
-        )
+        flush_betting_choices_to_database(self.database, [self])
 
         return
 
+    def create_report_copy(
+        self) -> 'SingleEvent':
+
+        # a detached copy that carries everything needed to render the event
+        # but not the database handle, so it can be sent to another process.
+        report_copy = self.__class__(None)
+        for slot in self.__slots__:
+            if slot != 'database' and slot != 'listeners':
+                report_copy.__setattr__(slot, getattr(self, slot))
+
+        return report_copy
+
     def print(
         self) -> None:
 
@@ -410,13 +527,9 @@ class SingleEvent:
         if not write:
             return
 
-        with open('/home/delancey/projects/dk/template.html', 'r') as f:
-            template = f.readlines()
-        f.close()
-
         game_time_string = f' ({self.game_date}, {self.game_time})' if (self.game_date and self.game_time) else ''
 
-        template = '\n'.join(template)
+        template = load_html_template()
         template = template.replace('REPLACE_TITLE', f'Summary of {self.away_team} @ {self.home_team}')
         template = template.replace('REPLACE_H1', f'Summary of <a href="{self.create_event_url()}">{self.away_team} @ {self.home_team}{game_time_string}</a>')
         template = template.replace('REPLACE_BODY', '\n'.join(plots))
@@ -433,7 +546,9 @@ class SingleEvent:
         if not self.betting_lines or not self.betting_lines[0].kenpom_event:
             return ''
 
-        kellys = list(map(lambda x: x.calculate_kelly_criterion(self.away_team, False) * 100, self.betting_lines))
+        import kelly
+
+        kellys = (kelly.SlateKelly([self]).history(self.event_id, kelly.AWAY) * 100).tolist()
         updates = list(map(lambda x: x.last_updated, self.betting_lines))
         return self.create_plot_html(
             updates,
@@ -451,7 +566,9 @@ class SingleEvent:
         if not self.betting_lines or not self.betting_lines[0].kenpom_event:
             return ''
 
-        kellys = list(map(lambda x: x.calculate_kelly_criterion(self.home_team, True) * 100, self.betting_lines))
+        import kelly
+
+        kellys = (kelly.SlateKelly([self]).history(self.event_id, kelly.HOME) * 100).tolist()
         updates = list(map(lambda x: x.last_updated, self.betting_lines))
         return self.create_plot_html(
             updates,
@@ -548,7 +665,7 @@ class SingleEvent:
             fixed_y = self.betting_lines[0].home_team_moneyline if self.betting_choices.bet_home_moneyline else None
         )
 
-    def create_plot_html(
+    def create_plot_figure_html(
         self,
         x_data: List[float],
         y_data: List[float],
@@ -557,6 +674,10 @@ class SingleEvent:
         title: str,
         **kwargs) -> str:
 
+        # reference renderer that builds a full plotly figure; kept for
+        # benchmarking against the direct spec renderer below.
+        import plotly.graph_objects as go
+
         layout = dict(
             title = title,
             xaxis = dict(
@@ -589,6 +710,36 @@ class SingleEvent:
         #fig.show()
         return fig.to_html(full_html = False, include_plotlyjs = 'cdn')
 
+    def create_plot_html(
+        self,
+        x_data: List[float],
+        y_data: List[float],
+        x_label: str,
+        y_label: str,
+        title: str,
+        **kwargs) -> str:
+
+        fixed_y = kwargs['fixed_y'] if 'fixed_y' in kwargs else None
+        fixed_y_label = ''
+        if fixed_y is not None:
+            fixed_y_label = kwargs['fixed_y_label'] if 'fixed_y_label' in kwargs else (f'Bet Placed: {"+" if fixed_y > 0 else ""}{fixed_y}')
+
+        # long-running events can have thousands of snapshots; keep every
+        # line change (and the first and latest values) up to a cap.
+        max_points = kwargs['max_points'] if 'max_points' in kwargs else downsample.DOWNSAMPLE_MAX_POINTS
+        x_data, y_data = downsample.downsample(x_data, y_data, max_points)
+
+        # emit the chart spec directly; building and validating a go.Figure
+        # only to serialize it again dominated the rendering cost.
+        return plot_spec.create_plot_html(
+            x_data,
+            y_data,
+            x_label,
+            y_label,
+            title,
+            fixed_y,
+            fixed_y_label)
+
 def populate_event_from_database(
     database,
     new_event: SingleEvent,
@@ -597,32 +748,97 @@ def populate_event_from_database(
     if database is None:
         return False
 
-    found = database.events.find_one({
-        'event_id': event_id
-    })
+    return populate_event_from_document(
+        new_event,
+        event_id,
+        database.find_event(event_id))
+
+def load_all_events_from_database(
+    database) -> List[SingleEvent]:
+
+    events = []
+    for document in database.find_all_events():
+        loaded_event = SingleEvent(None)
+        populate_event_from_document(loaded_event, document['event_id'], document)
+        events.append(loaded_event)
+
+    return events
+
+def populate_event_from_document(
+    new_event: SingleEvent,
+    event_id: str,
+    found: dict) -> bool:
 
     if not found:
         return False
 
-    #new_event = SingleEvent(database)
     new_event.event_id = event_id
     new_event.game_date = found['game_date'] if 'game_date' in found else ''
     new_event.game_time = found['game_time'] if 'game_time' in found else ''
     new_event.away_team = found['away_team'] if 'away_team' in found else ''
     new_event.home_team = found['home_team'] if 'home_team' in found else ''
-    new_event.game_date = found['game_date'] if 'game_date' in found else ''
 
     betting_lines = found['betting_lines'] if 'betting_lines' in found else []
     for lines in betting_lines:
         new_lines = EventLines()
         new_lines.load_from_database(lines)
-        new_event.add_update(new_lines)
+        new_event.add_update(new_lines, replay = True)
 
     betting_choices = found['betting_choices'] if 'betting_choices' in found else None
     if betting_choices:
         choices = BettingChoices()
         choices.load_from_database(betting_choices)
         new_event.betting_choices = choices
-        new_event.update_betting_choices_in_database()
+
+    outcome = found['outcome'] if 'outcome' in found else None
+    if outcome:
+        new_event.outcome = EventOutcome()
+        new_event.outcome.load_from_database(outcome)
 
     return True
+
+def update_events_in_database(
+    database,
+    events: List[SingleEvent]) -> None:
+
+    if database is None or not events:
+        return
+
+    # create any missing documents, then append the latest lines for every
+    # event, each as a single batched operation.
+    database.create_events(list(map(lambda e: e.create_database_document(), events)))
+
+    # the predictions the new lines refer to are upserted first, once each
+    predictions = {}
+    updates = []
+    for updated_event in events:
+        if updated_event.betting_lines:
+            kenpom_event = updated_event.betting_lines[-1].kenpom_event
+            if kenpom_event:
+                predictions[kenpom_event.create_id()] = kenpom_event.create_mongodb_dict()
+            updates.append((updated_event.event_id, updated_event.betting_lines[-1].create_mongodb_dict()))
+
+    database.upsert_kenpom_predictions(list(predictions.items()))
+    database.push_betting_lines(updates)
+
+    return
+
+def flush_betting_choices_to_database(
+    database,
+    events: List[SingleEvent]) -> int:
+
+    if database is None:
+        return 0
+
+    # collect every dirty set of choices and write them in a single batch.
+    # the updates are keyed on event_id, so no lookup is needed first.
+    dirty_events = list(filter(lambda e: e.betting_choices.dirty, events))
+    if not dirty_events:
+        return 0
+
+    database.set_betting_choices(list(map(lambda e: (e.event_id, e.betting_choices.create_mongodb_dict()), dirty_events)))
+
+    for dirty_event in dirty_events:
+        dirty_event.betting_choices.dirty = False
+
+    return len(dirty_events)
@@ -1,7 +1,7 @@
 from datetime import date, datetime
 from os import path
+import json
 import string
-import time
 from typing import List, Tuple
 
 from googleapiclient.discovery import Resource, build
@@ -11,7 +11,8 @@ import google.oauth2.credentials
 import google.oauth2.service_account
 
 from dk import DraftKingsEventGroup, DraftKingsSingleEvent, DK_STR_EVENTS_URL
-from event import BettingChoices
+from event import BettingChoices, flush_betting_choices_to_database
+from kelly import AWAY, HOME, SlateKelly
 import team_colors as tc
 
 GOOGLE_CLIENT_SECRETS_FILE = './keys/app_secret.json'
@@ -24,8 +25,17 @@ GOOGLE_API_SCOPES = ['https://www.googleapis.com/auth/drive.file', 'https://www.
 
 GOOGLE_SHEETS_BASE_URL = 'https://docs.google.com/spreadsheets/d'
 
-SLEEP_TIME = 3
-SLEEP_TIME_SHORT = 1
+# value ranges sent in a single values().batchUpdate
+GOOGLE_API_MAX_VALUE_RANGES = 500
+
+# rate limited (429) and server errors are retried with exponential backoff
+# by the api client instead of sleeping between calls
+GOOGLE_API_NUM_RETRIES = 5
+
+# limits on a single spreadsheets().batchUpdate; formatting requests are
+# accumulated across a sheet and flushed once either would be exceeded
+GOOGLE_API_MAX_BATCH_REQUESTS = 1000
+GOOGLE_API_MAX_BATCH_BYTES = 2 * 1024 * 1024
 
 GAME_LINK = 'Game Link'
 GAME_DATE = 'Date'
@@ -145,6 +155,84 @@ def get_spreadsheet_service() -> Resource:
 
     return service
 
+class SheetRequestBatch:
+    '''Formatting requests collected across a sheet and sent in as few batchUpdate calls as the API allows.'''
+
+    __slots__ = [
+        'service',
+        'spreadsheet_id',
+        'requests',
+        'size',
+        'calls'
+    ]
+
+    def __init__(
+        self,
+        service: Resource,
+        spreadsheet_id: str):
+
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.requests = []
+        self.size = 0
+        self.calls = 0
+
+        return
+
+    def add(
+        self,
+        requests: List[dict]) -> None:
+
+        # requests are applied in the order they are added, so a flush only
+        # ever splits the sequence, never reorders it
+        for request in requests:
+            size = len(json.dumps(request))
+            if self.requests and (len(self.requests) >= GOOGLE_API_MAX_BATCH_REQUESTS or self.size + size > GOOGLE_API_MAX_BATCH_BYTES):
+                self.flush()
+
+            self.requests.append(request)
+            self.size += size
+
+        return
+
+    def flush(
+        self) -> None:
+
+        if not self.requests:
+            return
+
+        body = {
+            'requests': self.requests
+        }
+
+        self.service.spreadsheets().batchUpdate(
+            spreadsheetId = self.spreadsheet_id,
+            body = body).execute(num_retries = GOOGLE_API_NUM_RETRIES)
+
+        self.requests = []
+        self.size = 0
+        self.calls += 1
+
+        return
+
+def send_requests(
+    service: Resource,
+    spreadsheet_id: str,
+    requests: List[dict],
+    **kwargs) -> None:
+
+    # requests go to the sheet's batch when one is given, otherwise they are
+    # sent right away
+    batch = kwargs['batch'] if 'batch' in kwargs else None
+    if batch is None:
+        batch = SheetRequestBatch(service, spreadsheet_id)
+        batch.add(requests)
+        batch.flush()
+    else:
+        batch.add(requests)
+
+    return
+
 def create_new_spreadsheet(
     service: Resource,
     spreadsheet_name: str) -> str:
@@ -332,15 +420,26 @@ def add_header_row(
 
     return True
 
-def add_event_rows(
-    service: Resource,
-    spreadsheet_id: str,
+def create_event_rows_data(
     sheet_name: str,
     event: DraftKingsSingleEvent,
     row: int,
-    update: bool) -> bool:
-
-    sheets = service.spreadsheets()
+    update: bool,
+    **kwargs) -> List[dict]:
+
+    # callers syncing a whole group pass one batched kelly engine for the
+    # slate; otherwise compute it for just this event.
+    slate_kelly = kwargs['slate_kelly'] if 'slate_kelly' in kwargs else None
+    if slate_kelly is None:
+        slate_kelly = SlateKelly([event])
+    starting_kelly = slate_kelly.starting(event.event_id)
+    latest_kelly = slate_kelly.latest(event.event_id)
+
+    # joint stakes from the portfolio optimizer replace the independent
+    # kelly values in the latest column
+    portfolio_stakes = kwargs['portfolio_stakes'] if 'portfolio_stakes' in kwargs else None
+    if portfolio_stakes is not None:
+        latest_kelly = portfolio_stakes[event.event_id] if event.event_id in portfolio_stakes else (0, 0)
 
     away_values = []
     home_values = []
@@ -391,7 +490,7 @@ def add_event_rows(
                 else:
                     away_kelly_latest_values[0].append(1 - event.betting_lines[-1].kenpom_event.confidence)
                 away_kelly_latest_values[0].append(f'=IF({kelly_latest_column}{row}>0,{matchup_column}{row},"")')
-                away_kelly_latest_values[0].append(event.betting_lines[-1].calculate_kelly_criterion(event.away_team, False))
+                away_kelly_latest_values[0].append(latest_kelly[AWAY])
 
         if not event.in_progress:
             # home team row
@@ -414,11 +513,11 @@ def add_event_rows(
                 else:
                     home_kelly_latest_values[0].append(1 - event.betting_lines[-1].kenpom_event.confidence)
                 home_kelly_latest_values[0].append(f'=IF({kelly_latest_column}{row + 1}>0,{matchup_column}{row + 1},"")')
-                home_kelly_latest_values[0].append(event.betting_lines[-1].calculate_kelly_criterion(event.home_team, True))
+                home_kelly_latest_values[0].append(latest_kelly[HOME])
     else:
         # if the event is in progress but we haven't seen it before, skip it
         if event.in_progress:
-            return True
+            return []
 
         start_column = SHEET_COLUMNS[0]
         stop_column = SHEET_COLUMNS[SHEET_HEADER_COLUMN_ORDER.index(MONEYLINE_MOVEMENT)]
@@ -459,13 +558,13 @@ def add_event_rows(
             else:
                 away_values[0].append(1 - event.betting_lines[0].kenpom_event.confidence)
             away_values[0].append(f'=IF({kelly_starting_column}{row}>0,{matchup_column}{row},"")') # best bet starting
-            away_values[0].append(event.betting_lines[0].calculate_kelly_criterion(event.away_team, False)) # kelly starting
+            away_values[0].append(starting_kelly[AWAY]) # kelly starting
             if event.away_team == event.betting_lines[0].kenpom_event.winning_team:
                 away_values[0].append(event.betting_lines[0].kenpom_event.confidence)
             else:
                 away_values[0].append(1 - event.betting_lines[0].kenpom_event.confidence)
             away_values[0].append(f'=IF({kelly_latest_column}{row}>0,{matchup_column}{row},"")') # best bet latest
-            away_values[0].append(event.betting_lines[0].calculate_kelly_criterion(event.away_team, False)) # kelly latest
+            away_values[0].append(latest_kelly[AWAY] if portfolio_stakes is not None else starting_kelly[AWAY]) # kelly latest
             stop_column = kelly_latest_column
 
         # home team row
@@ -500,13 +599,13 @@ def add_event_rows(
             else:
                 home_values[0].append(1 - event.betting_lines[0].kenpom_event.confidence)
             home_values[0].append(f'=IF({kelly_starting_column}{row + 1}>0,{matchup_column}{row + 1},"")') # best bet starting
-            home_values[0].append(event.betting_lines[0].calculate_kelly_criterion(event.home_team, True)) # kelly starting
+            home_values[0].append(starting_kelly[HOME]) # kelly starting
             if event.home_team == event.betting_lines[0].kenpom_event.winning_team:
                 home_values[0].append(event.betting_lines[0].kenpom_event.confidence)
             else:
                 home_values[0].append(1 - event.betting_lines[0].kenpom_event.confidence)
             home_values[0].append(f'=IF({kelly_latest_column}{row + 1}>0,{matchup_column}{row + 1},"")') # best bet latest
-            home_values[0].append(event.betting_lines[0].calculate_kelly_criterion(event.home_team, True)) # kelly latest
+            home_values[0].append(latest_kelly[HOME] if portfolio_stakes is not None else starting_kelly[HOME]) # kelly latest
             stop_column = kelly_latest_column
 
     away_range = f'{sheet_name}!{start_column}{row}:{stop_column}{row}'
@@ -542,16 +641,30 @@ def add_event_rows(
             }
         )
 
-    body = {
-        'data': data,
-        'valueInputOption': 'USER_ENTERED'
-    }
+    return data
 
-    sheets.values().batchUpdate(
-        spreadsheetId = spreadsheet_id,
-        body = body).execute()
+def write_value_ranges(
+    service: Resource,
+    spreadsheet_id: str,
+    data: List[dict]) -> int:
 
-    return True
+    sheets = service.spreadsheets()
+
+    # the value ranges of a whole sheet go out together, split only to keep
+    # each request a reasonable size
+    requests = 0
+    for i in range(0, len(data), GOOGLE_API_MAX_VALUE_RANGES):
+        body = {
+            'data': data[i:i + GOOGLE_API_MAX_VALUE_RANGES],
+            'valueInputOption': 'USER_ENTERED'
+        }
+
+        sheets.values().batchUpdate(
+            spreadsheetId = spreadsheet_id,
+            body = body).execute(num_retries = GOOGLE_API_NUM_RETRIES)
+        requests += 1
+
+    return requests
 
 def create_merge_cells_request(
     sheet_id: int,
@@ -1515,9 +1628,8 @@ def format_event_rows(
     sheet_id: int,
     event: DraftKingsSingleEvent,
     starting_row: int,
-    update: bool) -> bool:
-
-    sheets = service.spreadsheets()
+    update: bool,
+    **kwargs) -> bool:
 
     requests = []
 
@@ -1585,14 +1697,7 @@ def format_event_rows(
         for request in format_borders_request:
             requests.append(request)
 
-    body = {
-        'requests': requests
-    }
-
-    if requests:
-        sheets.batchUpdate(
-            spreadsheetId = spreadsheet_id,
-            body = body).execute()
+    send_requests(service, spreadsheet_id, requests, **kwargs)
 
     return True
 
@@ -1600,9 +1705,8 @@ def format_all_value_columns(
     service: Resource,
     spreadsheet_id: str,
     sheet_id: int,
-    format_kenpom: bool) -> bool:
-
-    sheets = service.spreadsheets()
+    format_kenpom: bool,
+    **kwargs) -> bool:
 
     requests = []
     starting_row = 3 # maybe?
@@ -1679,22 +1783,15 @@ def format_all_value_columns(
             for request in format_kenpom:
                 requests.append(request)
 
-    body = {
-        'requests': requests
-    }
-
-    sheets.batchUpdate(
-        spreadsheetId = spreadsheet_id,
-        body = body).execute()
+    send_requests(service, spreadsheet_id, requests, **kwargs)
 
     return True
 
 def format_auto_column_width(
     service: Resource,
     spreadsheet_id: str,
-    sheet_id: int) -> bool:
-
-    sheets = service.spreadsheets()
+    sheet_id: int,
+    **kwargs) -> bool:
 
     requests = []
 
@@ -1704,22 +1801,15 @@ def format_auto_column_width(
     for request in auto_width_request:
         requests.append(request)
 
-    body = {
-        'requests': auto_width_request
-    }
-
-    sheets.batchUpdate(
-        spreadsheetId = spreadsheet_id,
-        body = body).execute()
+    send_requests(service, spreadsheet_id, requests, **kwargs)
 
     return
 
 def format_conditional_formatting(
     service: Resource,
     spreadsheet_id: str,
-    sheet_id: int) -> bool:
-
-    sheets = service.spreadsheets()
+    sheet_id: int,
+    **kwargs) -> bool:
 
     requests = []
     format_conditional = create_conditional_formatting_rules_request(
@@ -1728,13 +1818,7 @@ def format_conditional_formatting(
     for request in format_conditional:
         requests.append(request)
 
-    body = {
-        'requests': requests
-    }
-
-    sheets.batchUpdate(
-        spreadsheetId = spreadsheet_id,
-        body = body).execute()
+    send_requests(service, spreadsheet_id, requests, **kwargs)
 
     return
 
@@ -1742,9 +1826,8 @@ def format_obsolete_event(
     service: Resource,
     spreadsheet_id: str,
     sheet_id: int,
-    row: int) -> bool:
-
-    sheets = service.spreadsheets()
+    row: int,
+    **kwargs) -> bool:
 
     requests = []
     format_obsolete = create_format_obsolete_event_request(
@@ -1754,13 +1837,7 @@ def format_obsolete_event(
     for request in format_obsolete:
         requests.append(request)
 
-    body = {
-        'requests': requests
-    }
-
-    sheets.batchUpdate(
-        spreadsheetId = spreadsheet_id,
-        body = body).execute()
+    send_requests(service, spreadsheet_id, requests, **kwargs)
 
     return
 
@@ -1771,25 +1848,29 @@ def format_sheet(
     sheet_name: str,
     last_updated: str,
     update: bool,
-    format_kenpom: bool) -> bool:
+    format_kenpom: bool,
+    **kwargs) -> bool:
 
     if not update:
         format_conditional_formatting(
             service,
             spreadsheet_id,
-            sheet_id)
+            sheet_id,
+            **kwargs)
 
     format_all_value_columns(
         service,
         spreadsheet_id,
         sheet_id,
-        format_kenpom)
+        format_kenpom,
+        **kwargs)
     #jmd: end if not update block
 
     format_auto_column_width(
         service,
         spreadsheet_id,
-        sheet_id)
+        sheet_id,
+        **kwargs)
 
     update_last_updated(
         service,
@@ -1898,16 +1979,21 @@ def create_new_spreadsheet_from_events(
 
         row = 3
         update = False
+        slate_kelly = SlateKelly(event_group.events)
 
+        # the values of every event are collected and written together, and
+        # so are the formatting requests of the whole sheet
+        data = []
+        batch = SheetRequestBatch(service, spreadsheet_id)
         for event in event_group.events:
             event.print()
-            add_event_rows(
-                service,
-                spreadsheet_id,
+            data += create_event_rows_data(
                 sheet_name,
                 event,
                 row,
-                update)
+                update,
+                slate_kelly = slate_kelly,
+                portfolio_stakes = event_group.portfolio_stakes)
 
             format_event_rows(
                 service,
@@ -1915,14 +2001,20 @@ def create_new_spreadsheet_from_events(
                 sheet_id,
                 event,
                 row,
-                update)
+                update,
+                batch = batch)
 
             print(f'Added new entry for {event.away_team} @ {event.home_team} ({event_index}/{event_count})')
             row += 3
             event_index += 1
 
-            time.sleep(SLEEP_TIME)
+        write_value_ranges(
+            service,
+            spreadsheet_id,
+            data)
 
+        # column widths are sized to the values, so the batch is flushed
+        # only after they are written
         format_sheet(
             service,
             spreadsheet_id,
@@ -1930,8 +2022,10 @@ def create_new_spreadsheet_from_events(
             sheet_name,
             event_group.last_updated,
             update,
-            include_kenpom
+            include_kenpom,
+            batch = batch
         )
+        batch.flush()
 
     print(f'Spreadsheet has been created and is available at: {create_spreadsheet_url(spreadsheet_id)}')
     print(f'To update: dk.py --update {spreadsheet_id}')
@@ -1960,12 +2054,23 @@ def update_spreadsheet_from_events(
             spreadsheet_id,
             sheet_name) + 3
 
+        sheet_choices = get_betting_choices_from_sheet(
+            service,
+            spreadsheet_id,
+            sheet_name,
+            event_ids)
+
         update = True
 
         sheet_id = event_group.sheet_id
         event_index = 1
         event_count = len(event_group.events)
+        slate_kelly = SlateKelly(event_group.events)
 
+        # the values of every event are collected and written together, and
+        # so are the formatting requests of the whole sheet
+        data = []
+        batch = SheetRequestBatch(service, spreadsheet_id)
         for event in event_group.events:
             event.print()
 
@@ -1982,13 +2087,13 @@ def update_spreadsheet_from_events(
             if event.event_id in event_ids:
                 row = event_ids[event.event_id] + 1 # i hate everything
 
-                add_event_rows(
-                    service,
-                    spreadsheet_id,
+                data += create_event_rows_data(
                     sheet_name,
                     event,
                     row,
-                    update)
+                    update,
+                    slate_kelly = slate_kelly,
+                    portfolio_stakes = event_group.portfolio_stakes)
 
                 format_event_rows(
                     service,
@@ -1996,21 +2101,17 @@ def update_spreadsheet_from_events(
                     sheet_id,
                     event,
                     row,
-                    update)
-
-                betting_choices = get_betting_choices_from_spreadsheet(
-                    service,
-                    spreadsheet_id,
-                    sheet_name,
-                    row)
+                    update,
+                    batch = batch)
 
-                event.betting_choices = betting_choices
-                event.update_betting_choices_in_database()
+                betting_choices = sheet_choices[event.event_id]
 
-                # jmd: temporarily disable generating html until we know
-                # what we actually want to record and plot.
-                filename = f'/home/delancey/projects/dk/plots/{event_group.database_name}/{event.event_id}.html'
-                event.write_html(filename)
+                # only mark the choices dirty if they changed; everything
+                # dirty is flushed in a single batch once the group is done.
+                # newly ticked choices record the lines they were placed at.
+                event.betting_choices.update_from_choices(
+                    betting_choices,
+                    lines = event.betting_lines[-1] if event.betting_lines else None)
 
                 print(f'Updated data for event: {event.away_team} @ {event.home_team} ({event_index}/{event_count})')
                 del event_ids[event.event_id]
@@ -2018,13 +2119,13 @@ def update_spreadsheet_from_events(
                 row = num_rows
                 num_rows += 3
 
-                add_event_rows(
-                    service,
-                    spreadsheet_id,
+                data += create_event_rows_data(
                     sheet_name,
                     event,
                     row,
-                    False)
+                    False,
+                    slate_kelly = slate_kelly,
+                    portfolio_stakes = event_group.portfolio_stakes)
 
                 format_event_rows(
                     service,
@@ -2032,13 +2133,22 @@ def update_spreadsheet_from_events(
                     sheet_id,
                     event,
                     row,
-                    False)
+                    False,
+                    batch = batch)
 
                 print(f'Added data for event: {event.away_team} @ {event.home_team} ({event_index}/{event_count})')
 
-            time.sleep(SLEEP_TIME)
             event_index += 1
 
+        write_value_ranges(
+            service,
+            spreadsheet_id,
+            data)
+
+        flush_betting_choices_to_database(
+            event_group.database,
+            event_group.events)
+
         event_rows_reversed = list(event_ids.values())
         event_rows_reversed.reverse()
         event_index = 0
@@ -2050,13 +2160,15 @@ def update_spreadsheet_from_events(
 
             # jmd: move to a new sheet (or spreadsheet) of completed events so
             # that we can track how the lines moved and how our picks performed
+
+            # the rows are deleted bottom up once every value is written, so
+            # the row numbers used above stay valid
             format_obsolete_event(
                 service,
                 spreadsheet_id,
                 sheet_id,
-                row)
-
-            time.sleep(SLEEP_TIME_SHORT)
+                row,
+                batch = batch)
 
         format_sheet(
             service,
@@ -2065,8 +2177,10 @@ def update_spreadsheet_from_events(
             sheet_name,
             event_group.last_updated,
             update,
-            event_group.include_kenpom
+            event_group.include_kenpom,
+            batch = batch
         )
+        batch.flush()
 
         sheet_id += 1
 
@@ -2075,11 +2189,11 @@ def update_spreadsheet_from_events(
 
     return True
 
-def get_betting_choices_from_spreadsheet(
+def get_betting_choices_from_sheet(
     service: Resource,
     spreadsheet_id: str,
     sheet_name: str,
-    row: int) -> BettingChoices:
+    event_ids: dict) -> dict:
 
     indices = [
         SHEET_HEADER_COLUMN_ORDER.index(BET_SPREAD),
@@ -2088,29 +2202,45 @@ def get_betting_choices_from_spreadsheet(
     ]
     columns = list(map(lambda x: SHEET_COLUMNS[x], indices))
 
+    # the checkbox columns of the whole sheet are read in one call, from the
+    # first event row down
+    first_row = 3 # 1-based
     requested_ranges = []
     for column in columns:
-        requested_ranges.append(f'{sheet_name}!{column}{row}:{column}{row + 1}')
+        requested_ranges.append(f'{sheet_name}!{column}{first_row}:{column}')
 
     request = service.spreadsheets().values().batchGet(
         spreadsheetId = spreadsheet_id,
-        ranges = requested_ranges)
-    response = request.execute()
-
-    betting_choices = BettingChoices()
-
-    if 'valueRanges' not in response or len(response['valueRanges']) != 3:
-        return betting_choices
-
-    value_ranges = response['valueRanges']
-    betting_choices.bet_away_spread = True if value_ranges[0]['values'][0][0] == 'TRUE' else False
-    betting_choices.bet_home_spread = True if value_ranges[0]['values'][1][0] == 'TRUE' else False
-    betting_choices.bet_over = True if value_ranges[1]['values'][0][0] == 'TRUE' else False
-    betting_choices.bet_under = True if value_ranges[1]['values'][1][0] == 'TRUE' else False
-    betting_choices.bet_away_moneyline = True if value_ranges[2]['values'][0][0] == 'TRUE' else False
-    betting_choices.bet_home_moneyline = True if value_ranges[2]['values'][1][0] == 'TRUE' else False
-
-    return betting_choices
+        ranges = requested_ranges,
+        majorDimension = 'COLUMNS')
+    response = request.execute(num_retries = GOOGLE_API_NUM_RETRIES)
+
+    value_ranges = response['valueRanges'] if 'valueRanges' in response else []
+    values = []
+    for i in range(len(columns)):
+        column_values = value_ranges[i]['values'] if i < len(value_ranges) and 'values' in value_ranges[i] else [[]]
+        values.append(column_values[0])
+
+    # trailing unchecked cells are not returned, so anything past the end of
+    # a column is unticked
+    def is_checked(column: int, row: int) -> bool:
+        offset = row - first_row
+        return offset < len(values[column]) and values[column][offset] == 'TRUE'
+
+    # event ids map to the 0-based index of the away row
+    choices = {}
+    for event_id, row_index in event_ids.items():
+        row = row_index + 1
+        betting_choices = BettingChoices()
+        betting_choices.bet_away_spread = is_checked(0, row)
+        betting_choices.bet_home_spread = is_checked(0, row + 1)
+        betting_choices.bet_over = is_checked(1, row)
+        betting_choices.bet_under = is_checked(1, row + 1)
+        betting_choices.bet_away_moneyline = is_checked(2, row)
+        betting_choices.bet_home_moneyline = is_checked(2, row + 1)
+        choices[event_id] = betting_choices
+
+    return choices
 
 def get_event_ids_from_sheet(
     service: Resource,
@@ -2122,7 +2252,7 @@ def get_event_ids_from_sheet(
         spreadsheetId = spreadsheet_id,
         range = requested_range,
         valueRenderOption = 'FORMULA') # needed to return the hyperlink formula, not its rendered value of "LINK"
-    response = request.execute()
+    response = request.execute(num_retries = GOOGLE_API_NUM_RETRIES)
 
     event_ids = {}
     row_index = 2
@@ -2149,6 +2279,6 @@ def get_number_of_rows(
     request = service.spreadsheets().values().get(
         spreadsheetId = spreadsheet_id,
         range = requested_range)
-    response = request.execute()
+    response = request.execute(num_retries = GOOGLE_API_NUM_RETRIES)
 
     return len(response['values'])
@@ -0,0 +1,133 @@
+import numpy as np
+from typing import List, Tuple
+
+AWAY = 0
+HOME = 1
+
+def to_float(
+    value) -> float:
+
+    # lines loaded from older database documents may hold '' for missing
+    # values; treat anything non-numeric as a missing (zero) line.
+    return float(value) if isinstance(value, (int, float)) else 0.0
+
+def american_to_decimal(
+    moneylines) -> np.ndarray:
+
+    moneylines = np.asarray(moneylines, dtype = float)
+    favorite = moneylines < 0
+
+    # a missing moneyline (0) maps to decimal odds of 1, i.e. no payout
+    return np.where(
+        favorite,
+        100 / np.where(favorite, -moneylines, 1) + 1,
+        moneylines / 100 + 1)
+
+def implied_probability(
+    decimal_odds) -> np.ndarray:
+
+    decimal_odds = np.asarray(decimal_odds, dtype = float)
+    valid = decimal_odds > 1
+
+    return np.where(valid, 1 / np.where(valid, decimal_odds, 1), np.nan)
+
+def no_vig_probability(
+    away_implied_probability,
+    home_implied_probability) -> np.ndarray:
+
+    # normalize both sides so they sum to one, removing the book's margin
+    total = np.asarray(away_implied_probability) + np.asarray(home_implied_probability)
+    return np.stack([away_implied_probability / total, home_implied_probability / total], axis = -1)
+
+def kelly_fraction(
+    probability,
+    decimal_odds) -> np.ndarray:
+
+    probability = np.asarray(probability, dtype = float)
+    b = np.asarray(decimal_odds, dtype = float) - 1
+    has_odds = b != 0
+
+    return np.where(has_odds, (b * probability - (1 - probability)) / np.where(has_odds, b, 1), 0.0)
+
+
+class SlateKelly:
+    '''Odds, probabilities, edges and Kelly fractions for every side of every snapshot in a slate.'''
+
+    __slots__ = [
+        'offsets',
+        'moneyline',
+        'decimal_odds',
+        'implied_probability',
+        'no_vig_probability',
+        'probability',
+        'edge',
+        'kelly'
+    ]
+
+    def __init__(
+        self,
+        events: List):
+
+        # flatten every snapshot of every event into (away, home) rows; each
+        # event owns a contiguous [start, end) slice of the arrays.
+        self.offsets = {}
+        moneylines = []
+        probabilities = []
+        for slate_event in events:
+            start = len(moneylines)
+            for lines in slate_event.betting_lines:
+                moneylines.append((to_float(lines.away_team_moneyline), to_float(lines.home_team_moneyline)))
+
+                kenpom_event = lines.kenpom_event
+                if kenpom_event:
+                    away = kenpom_event.confidence if kenpom_event.winning_team == slate_event.away_team else 1 - kenpom_event.confidence
+                    home = kenpom_event.confidence if kenpom_event.winning_team == slate_event.home_team else 1 - kenpom_event.confidence
+                    probabilities.append((away, home))
+                else:
+                    probabilities.append((np.nan, np.nan))
+
+            self.offsets[slate_event.event_id] = (start, len(moneylines))
+
+        self.moneyline = np.array(moneylines, dtype = float).reshape(-1, 2)
+        self.probability = np.array(probabilities, dtype = float).reshape(-1, 2)
+
+        self.decimal_odds = american_to_decimal(self.moneyline)
+        self.implied_probability = implied_probability(self.decimal_odds)
+        self.no_vig_probability = no_vig_probability(self.implied_probability[:, AWAY], self.implied_probability[:, HOME])
+        self.edge = self.probability - self.implied_probability
+
+        # without a kenpom prediction there is no kelly value to offer
+        self.kelly = np.where(np.isnan(self.probability), 0.0, kelly_fraction(self.probability, self.decimal_odds))
+
+        return
+
+    def history(
+        self,
+        event_id: str,
+        side: int) -> np.ndarray:
+
+        start, end = self.offsets[event_id]
+
+        # python's round is correctly rounded on the binary value (as the
+        # sheet has always shown), whereas np.round can differ on near-halves
+        return np.array(list(map(lambda k: round(k, 2), self.kelly[start:end, side].tolist())))
+
+    def starting(
+        self,
+        event_id: str) -> Tuple[float, float]:
+
+        start, end = self.offsets[event_id]
+        if start == end:
+            return (0, 0)
+
+        return (round(float(self.kelly[start, AWAY]), 2), round(float(self.kelly[start, HOME]), 2))
+
+    def latest(
+        self,
+        event_id: str) -> Tuple[float, float]:
+
+        start, end = self.offsets[event_id]
+        if start == end:
+            return (0, 0)
+
+        return (round(float(self.kelly[end - 1, AWAY]), 2), round(float(self.kelly[end - 1, HOME]), 2))
@@ -1,12 +1,14 @@
-from bs4 import BeautifulSoup as bs
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from functools import lru_cache
+import hashlib
+import json
+from os import chmod, path, replace
 import re
-from selenium import webdriver
 import time
 from typing import List
 
 import team_index
-import kenpom_credentials as kpc
 
 KP_STR_FANMATCH_TABLE_TAG = 'table'
 KP_STR_FANMATCH_TABLE_ID = 'fanmatch-table'
@@ -14,6 +16,69 @@ KP_STR_FANMATCH_TABLE_ID = 'fanmatch-table'
 KP_STR_FANMATCH_ROW_TAG = 'tr'
 KP_STR_FANMATCH_COLUMN_TAG = 'td'
 
+KP_STR_RATINGS_TABLE_TAG = 'table'
+KP_STR_RATINGS_TABLE_ID = 'ratings-table'
+
+# columns of the ratings table: rank, team, conference, record, adjusted
+# efficiency margin, then each adjusted rating followed by its rank
+KP_RATINGS_TEAM_COLUMN = 1
+KP_RATINGS_OFFENSE_COLUMN = 5
+KP_RATINGS_DEFENSE_COLUMN = 7
+KP_RATINGS_TEMPO_COLUMN = 9
+
+KP_STR_LOGIN_FIELD = 'name="password"'
+
+# rows of the fanmatch table, selected by lxml in one query
+KP_XPATH_FANMATCH_ROWS = f'//{KP_STR_FANMATCH_TABLE_TAG}[@id="{KP_STR_FANMATCH_TABLE_ID}"]//{KP_STR_FANMATCH_ROW_TAG}'
+
+# '12 Duke at 45 North Carolina': the rank (or NR) is dropped from each
+# team, and neutral site games use 'vs.' instead of 'at'
+KP_RE_FANMATCH_GAME = re.compile(r'^(?:(?:\d+|NR) )?(.+?) (at|vs\.) (?:(?:\d+|NR) )?(.+)$')
+
+KP_XPATH_RATINGS_ROWS = f'//{KP_STR_RATINGS_TABLE_TAG}[@id="{KP_STR_RATINGS_TABLE_ID}"]//{KP_STR_FANMATCH_ROW_TAG}'
+
+# tournament seeds follow the team name in the ratings table
+KP_RE_RATINGS_TEAM = re.compile(r'^(.+?)(?: \d+)?$')
+
+# 'Duke 75-70 (64%)': winning team, predicted score and confidence
+KP_RE_FANMATCH_PREDICTION = re.compile(r'^(\D*?)\s*(\d+-\d+)\s*\((\d+(?:\.\d+)?)%')
+
+KP_FANMATCH_URL = 'https://kenpom.com/fanmatch.php'
+KP_RATINGS_URL = 'https://kenpom.com/index.php'
+KP_LOGIN_URL = 'https://kenpom.com/handlers/login_handler.php'
+
+# authenticated cookies are kept between runs so we only log in when the
+# session has expired
+KP_COOKIE_FILE = './kenpom_cookies.json'
+
+# parsed fanmatch predictions are cached per date; they change about once a
+# day, so polls within the ttl never touch kenpom
+KP_CACHE_FILE = './kenpom_cache.json'
+KP_CACHE_TTL = 6 * 60 * 60
+
+# a date fanmatch lists no games for is cached too, but only briefly, since
+# its games may simply not have been posted yet
+KP_CACHE_EMPTY_TTL = 30 * 60
+
+# the ratings table is refreshed once a day, so it is cached by date under
+# its own key rather than by the ttl
+KP_CACHE_RATINGS_KEY = 'ratings'
+
+# where a prediction came from: the fanmatch row for the game, or the
+# ratings model for games fanmatch does not list
+KP_SOURCE_FANMATCH = 'fanmatch'
+KP_SOURCE_RATINGS = 'ratings'
+
+# hex digits of the prediction content hash kept in its id
+KP_ID_DIGEST_LENGTH = 12
+
+# number of fanmatch dates fetched at once
+KP_FETCH_WORKERS = 4
+
+KP_REQUEST_TIMEOUT = 10
+KP_POOL_SIZE = 8
+KP_USER_AGENT = 'Mozilla/5.0 (X11; CrOS x86_64 12871.102.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.141 Safari/537.36'
+
 def standardize_team_name(
     name: str,
     all_names: dict) -> str:
@@ -26,16 +91,26 @@ def standardize_team_name(
 
     return name
 
+@lru_cache(maxsize = None)
+def standardize_fanmatch_name(
+    name: str) -> str:
+
+    # the same teams appear on every fanmatch page, so each name is only
+    # standardized once per run
+    return standardize_team_name(name, team_index.NAME_REPLACEMENT_DICT)
+
 
 class KenPomEvent:
 
     __slots__ = [
         'last_updated',
+        'game_date',
         'away_team',
         'home_team',
         'winning_team',
         'score',
-        'confidence'
+        'confidence',
+        'source'
     ]
 
     def __init__(
@@ -51,11 +126,13 @@ class KenPomEvent:
         db_entry: dict):
 
         self.last_updated = db_entry['last_updated'] if 'last_updated' in db_entry else ''
+        self.game_date = db_entry['game_date'] if 'game_date' in db_entry else ''
         self.away_team = db_entry['away_team'] if 'away_team' in db_entry else ''
         self.home_team = db_entry['home_team'] if 'home_team' in db_entry else ''
         self.winning_team = db_entry['winning_team'] if 'winning_team' in db_entry else ''
         self.score = db_entry['score'] if 'score' in db_entry else ''
         self.confidence = db_entry['confidence'] if 'confidence' in db_entry else ''
+        self.source = db_entry['source'] if 'source' in db_entry else KP_SOURCE_FANMATCH
 
         return
 
@@ -67,51 +144,34 @@ class KenPomEvent:
         if not columns or len(columns) < 2:
             return
 
-        teams = columns[0].text.strip()
-        prediction = columns[1].text.strip()
+        self.load_from_text(
+            columns[0].text,
+            columns[1].text,
+            f'{date.today()} {datetime.now().strftime("%H:%M:%S")}')
 
-        team_a = ''
-        team_b = ''
-        split = ' at '
-        if ' vs. ' in teams:
-            split = ' vs. '
-
-        result = re.split(split, teams)
-        if not result or len(result) < 2:
-            return
-
-        team_a = result[0].strip()
-        team_b = result[1].strip()
-
-        if not 'NR ' in team_a:
-            team_a = re.split('\d* ', team_a, 1)[1]
-        else:
-            team_a = re.split('NR ', team_a, 1)[1]
+        return
 
-        if not 'NR ' in team_b:
-            team_b = re.split('\d* ', team_b, 1)[1]
-        else:
-            team_b = re.split('NR ', team_b, 1)[1]
+    def load_from_text(
+        self,
+        teams: str,
+        prediction: str,
+        last_updated: str) -> None:
 
-        team_a = standardize_team_name(team_a, team_index.NAME_REPLACEMENT_DICT)
-        team_b = standardize_team_name(team_b, team_index.NAME_REPLACEMENT_DICT)
-        self.home_team = team_b
-        self.away_team = team_a
-        if split == ' vs. ':
-            self.home_team = team_b
-            self.away_team = team_a
+        game = KP_RE_FANMATCH_GAME.match(teams.strip())
+        if not game:
+            return
 
-        score = re.search('(\d*-\d*)', prediction)
-        percent = re.search('(\(.*%)', prediction)
-        winning_team = re.search('([^\d]*)', prediction)
+        self.away_team = standardize_fanmatch_name(game.group(1).strip())
+        self.home_team = standardize_fanmatch_name(game.group(3).strip())
 
-        if score and percent and winning_team:
-            self.score = score.group(0).strip()
-            self.winning_team = standardize_team_name(winning_team.group(0).strip(), team_index.NAME_REPLACEMENT_DICT)
-            self.confidence = float(percent.group(0).strip()[1:-1])
-            self.confidence = self.confidence / 100.0
+        result = KP_RE_FANMATCH_PREDICTION.match(prediction.strip())
+        if result:
+            self.winning_team = standardize_fanmatch_name(result.group(1).strip())
+            self.score = result.group(2)
+            self.confidence = float(result.group(3)) / 100.0
 
-        self.last_updated = f'{date.today()} {datetime.now().strftime("%H:%M:%S")}'
+        self.last_updated = last_updated
+        self.source = KP_SOURCE_FANMATCH
 
         return
 
@@ -124,49 +184,483 @@ class KenPomEvent:
 
         return False
 
+    def create_id(
+        self) -> str:
+
+        # predictions are stored once per game, date and content: a repeated
+        # prediction shares its id, while one that changed during the day or
+        # came from the other source is kept alongside it. older predictions
+        # carry no game date and fall back to the day they were read.
+        day = self.game_date if self.game_date else self.last_updated[0:10]
+        content = json.dumps([self.winning_team, self.score, self.confidence, self.source])
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[0:KP_ID_DIGEST_LENGTH]
+
+        return f'{day}|{self.away_team}|{self.home_team}|{digest}'
+
     def create_mongodb_dict(
         self) -> dict:
 
         d = {
             'last_updated': self.last_updated,
+            'game_date': self.game_date,
             'away_team': self.away_team,
             'home_team': self.home_team,
             'winning_team': self.winning_team,
             'score': self.score,
-            'confidence': self.confidence
+            'confidence': self.confidence,
+            'source': self.source
         }
 
         return d
 
 
-def get_kenpom_events() -> List[KenPomEvent]:
+class KenPomSession:
+    '''An authenticated, pooled HTTP session for kenpom.com.'''
+
+    __slots__ = [
+        'cookie_file',
+        'session'
+    ]
+
+    def __init__(
+        self,
+        cookie_file: str):
+
+        # requests is only needed when kenpom is requested
+        import requests
+
+        self.cookie_file = cookie_file
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': KP_USER_AGENT})
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = KP_POOL_SIZE))
+
+        self.load_cookies()
+
+        return
+
+    def load_cookies(
+        self) -> bool:
+
+        if not path.exists(self.cookie_file):
+            return False
+
+        try:
+            with open(self.cookie_file, 'r') as f:
+                cookies = json.load(f)
+        except ValueError:
+            return False
+
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain = cookie['domain'], path = cookie['path'])
+
+        return True
+
+    def save_cookies(
+        self) -> None:
+
+        cookies = list(map(
+            lambda c: {'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path},
+            self.session.cookies))
+
+        # the cookies are as good as the credentials, so keep them private
+        with open(self.cookie_file, 'w') as f:
+            json.dump(cookies, f)
+        chmod(self.cookie_file, 0o600)
+
+        return
+
+    def is_authenticated(
+        self,
+        html: str,
+        marker: str,
+        require_login: bool = True) -> bool:
+
+        # the login form is shown in place of the predictions when the
+        # session has expired; public pages show it in the sidebar as well,
+        # so for those the marker alone is enough
+        if not require_login:
+            return marker in html
+
+        return marker in html and KP_STR_LOGIN_FIELD not in html
+
+    def login_http(
+        self) -> bool:
+
+        import kenpom_credentials as kpc
+
+        data = {
+            'email': kpc.email,
+            'password': kpc.password,
+            'submit': 'Login!'
+        }
+        response = self.session.post(KP_LOGIN_URL, data = data, timeout = KP_REQUEST_TIMEOUT)
+
+        return response.ok
+
+    def login_browser(
+        self) -> bool:
+
+        # the browser is the last resort when the login form cannot be posted
+        # directly; its cookies are handed over to the http session.
+        from selenium import webdriver
+
+        import kenpom_credentials as kpc
+
+        browser_options = webdriver.ChromeOptions()
+        browser_options.add_argument('--no-sandbox')
+        browser_options.add_argument('--headless')
+        browser_options.add_argument('--disable-gpu')
+        browser = webdriver.Chrome(chrome_options = browser_options)
+        browser.get(KP_FANMATCH_URL)
+
+        email = browser.find_element_by_name('email')
+        email.send_keys(kpc.email)
+        password = browser.find_element_by_name('password')
+        password.send_keys(kpc.password)
+        login = browser.find_element_by_name('submit')
+        login.click()
+
+        for cookie in browser.get_cookies():
+            self.session.cookies.set(cookie['name'], cookie['value'], domain = cookie['domain'], path = cookie['path'] if 'path' in cookie else '/')
+
+        browser.close()
+
+        return True
+
+    def fetch(
+        self,
+        url: str,
+        **kwargs) -> str:
+
+        import requests
+
+        params = kwargs['params'] if 'params' in kwargs else None
+        marker = kwargs['marker'] if 'marker' in kwargs else KP_STR_FANMATCH_TABLE_ID
+        require_login = kwargs['require_login'] if 'require_login' in kwargs else True
+
+        # try the persisted session first, then log in over http, and only
+        # fall back to a browser if both fail
+        for login in (None, self.login_http, self.login_browser):
+            if login is not None:
+                try:
+                    if not login():
+                        continue
+                except Exception as e:
+                    print(f'KenPom login failed ({login.__name__}): {str(e)}')
+                    continue
+
+            # a timeout or connection error is not a login problem, so it
+            # is not retried; the caller gets an empty page it won't cache
+            try:
+                response = self.session.get(url, params = params, timeout = KP_REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                print(f'Unable to retrieve KenPom page {url}: {str(e)}')
+                return ''
+
+            if response.ok and self.is_authenticated(response.text, marker, require_login):
+                if login is not None:
+                    self.save_cookies()
+                return response.text
+
+        print(f'Unable to retrieve an authenticated KenPom page: {url}')
+
+        return ''
+
+class KenPomCache:
+    '''Parsed fanmatch predictions by date and the day's ratings, backed by a file.'''
+
+    __slots__ = [
+        'filename',
+        'ttl',
+        'entries'
+    ]
+
+    def __init__(
+        self,
+        filename: str,
+        ttl: int):
+
+        # date -> {'fetched': epoch seconds, 'events': [kenpom event dicts]},
+        # plus the ratings of the day under their own key
+        self.filename = filename
+        self.ttl = ttl
+        self.entries = {}
+
+        if filename and path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+        return
+
+    def is_expired(
+        self,
+        entry: dict,
+        now: float) -> bool:
+
+        ttl = self.ttl if entry['events'] else min(self.ttl, KP_CACHE_EMPTY_TTL)
+
+        return now - entry['fetched'] > ttl
+
+    def get(
+        self,
+        day: str) -> List[KenPomEvent]:
+
+        if day not in self.entries or self.is_expired(self.entries[day], time.time()):
+            return None
 
-    browser_options = webdriver.ChromeOptions()
-    browser_options.add_argument('--no-sandbox')
-    browser_options.add_argument('--headless')
-    browser_options.add_argument('--disable-gpu')
-    browser = webdriver.Chrome(chrome_options = browser_options)
-    browser.get('https://kenpom.com/fanmatch.php')
+        events = []
+        for entry in self.entries[day]['events']:
+            event = KenPomEvent()
+            event.load_from_database(entry)
+            events.append(event)
 
-    email = browser.find_element_by_name('email')
-    email.send_keys(kpc.email)
-    password = browser.find_element_by_name('password')
-    password.send_keys(kpc.password)
-    login = browser.find_element_by_name('submit')
-    login.click()
+        return events
 
-    doc = bs(browser.page_source, 'html.parser')
-    time.sleep(1)
-    browser.close()
+    def put(
+        self,
+        day: str,
+        events: List[KenPomEvent]) -> None:
 
-    table = doc.find([KP_STR_FANMATCH_TABLE_TAG], id = KP_STR_FANMATCH_TABLE_ID)
-    rows = table.find_all([KP_STR_FANMATCH_ROW_TAG])
+        self.entries[day] = {
+            'fetched': time.time(),
+            'events': list(map(lambda e: e.create_mongodb_dict(), events))
+        }
+        self.save()
+
+        return
+
+    def get_ratings(
+        self,
+        day: str) -> List[dict]:
+
+        if KP_CACHE_RATINGS_KEY not in self.entries or self.entries[KP_CACHE_RATINGS_KEY]['day'] != day:
+            return None
+
+        return self.entries[KP_CACHE_RATINGS_KEY]['ratings']
+
+    def put_ratings(
+        self,
+        day: str,
+        ratings: List[dict]) -> None:
+
+        self.entries[KP_CACHE_RATINGS_KEY] = {
+            'fetched': time.time(),
+            'day': day,
+            'ratings': ratings
+        }
+        self.save()
+
+        return
+
+    def invalidate(
+        self,
+        day: str = None) -> None:
+
+        # drop one date, or everything when no date is given
+        if day is None:
+            self.entries = {}
+        elif day in self.entries:
+            del self.entries[day]
+        self.save()
+
+        return
+
+    def save(
+        self) -> None:
+
+        if not self.filename:
+            return
+
+        # expired dates are dropped whenever the cache is written
+        now = time.time()
+        self.entries = dict(filter(lambda e: e[0] == KP_CACHE_RATINGS_KEY or not self.is_expired(e[1], now), self.entries.items()))
+
+        with open(f'{self.filename}.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        replace(f'{self.filename}.tmp', self.filename)
+
+        return
+
+def parse_fanmatch(
+    html: str,
+    day: str) -> List[KenPomEvent]:
+
+    from lxml import html as lxml_html
+
+    if not html:
+        return []
+
+    # a single lxml pass: one xpath query for the rows, then the first two
+    # cells of each row are read as text and matched once.
+    doc = lxml_html.fromstring(html)
+    last_updated = f'{date.today()} {datetime.now().strftime("%H:%M:%S")}'
 
     events = []
-    for row in rows:
+    for row in doc.xpath(KP_XPATH_FANMATCH_ROWS):
+        columns = row.findall(KP_STR_FANMATCH_COLUMN_TAG)
+        if len(columns) < 2:
+            continue
+
         event = KenPomEvent()
-        event.load_from_row(row)
+        event.load_from_text(columns[0].text_content(), columns[1].text_content(), last_updated)
+        event.game_date = day
         if event.home_team and event.away_team:
             events.append(event)
 
     return events
+
+def fetch_fanmatch(
+    session: KenPomSession,
+    day: str) -> List[KenPomEvent]:
+
+    # None when no authenticated page could be retrieved, as opposed to an
+    # empty list for a date without games
+    html = session.fetch(KP_FANMATCH_URL, params = {'d': day})
+    if not html:
+        return None
+
+    return parse_fanmatch(html, day)
+
+
+def parse_ratings(
+    html: str) -> List[dict]:
+
+    from lxml import html as lxml_html
+
+    if not html:
+        return []
+
+    doc = lxml_html.fromstring(html)
+
+    # header rows repeat through the table body and have no data cells
+    ratings = []
+    for row in doc.xpath(KP_XPATH_RATINGS_ROWS):
+        columns = row.findall(KP_STR_FANMATCH_COLUMN_TAG)
+        if len(columns) <= KP_RATINGS_TEMPO_COLUMN:
+            continue
+
+        links = columns[KP_RATINGS_TEAM_COLUMN].findall('a')
+        team = links[0].text_content() if links else columns[KP_RATINGS_TEAM_COLUMN].text_content()
+        try:
+            ratings.append({
+                'team': standardize_fanmatch_name(KP_RE_RATINGS_TEAM.match(team.strip()).group(1)),
+                'offense': float(columns[KP_RATINGS_OFFENSE_COLUMN].text_content()),
+                'defense': float(columns[KP_RATINGS_DEFENSE_COLUMN].text_content()),
+                'tempo': float(columns[KP_RATINGS_TEMPO_COLUMN].text_content())
+            })
+        except (AttributeError, ValueError):
+            continue
+
+    return ratings
+
+def get_kenpom_ratings(
+    **kwargs) -> List[dict]:
+
+    cache = kwargs['cache'] if 'cache' in kwargs else None
+    day = str(date.today())
+
+    ratings = cache.get_ratings(day) if cache is not None else None
+    if ratings is not None:
+        return ratings
+
+    # the ratings table is public, so it is accepted without logging in even
+    # though the page carries a login form
+    session = kwargs['session'] if 'session' in kwargs else KenPomSession(KP_COOKIE_FILE)
+    ratings = parse_ratings(session.fetch(KP_RATINGS_URL, marker = KP_STR_RATINGS_TABLE_ID, require_login = False))
+    print(f'Retrieved KenPom ratings for {len(ratings)} teams')
+
+    if cache is not None and ratings:
+        cache.put_ratings(day, ratings)
+
+    return ratings
+
+
+class KenPomIndex:
+    '''KenPom predictions looked up by game date and team.'''
+
+    __slots__ = [
+        'events',
+        'teams'
+    ]
+
+    def __init__(
+        self,
+        events_by_date: dict):
+
+        # date -> predictions, and (date, team) -> prediction
+        self.events = events_by_date
+        self.teams = {}
+        for day, events in events_by_date.items():
+            for event in events:
+                self.teams[(day, event.away_team)] = event
+                self.teams[(day, event.home_team)] = event
+
+        return
+
+    def find(
+        self,
+        day: str,
+        team: str) -> KenPomEvent:
+
+        key = (day, team)
+
+        return self.teams[key] if key in self.teams else None
+
+def get_kenpom_events_by_date(
+    days: List[str],
+    **kwargs) -> dict:
+
+    cache = kwargs['cache'] if 'cache' in kwargs else None
+    max_workers = kwargs['max_workers'] if 'max_workers' in kwargs else KP_FETCH_WORKERS
+
+    events_by_date = {}
+    missing = []
+    for day in sorted(set(days)):
+        events = cache.get(day) if cache is not None else None
+        if events is not None:
+            events_by_date[day] = events
+        else:
+            missing.append(day)
+
+    if len(events_by_date):
+        print(f'Using cached KenPom predictions for {", ".join(sorted(events_by_date))}')
+
+    if not missing:
+        return events_by_date
+
+    session = kwargs['session'] if 'session' in kwargs else KenPomSession(KP_COOKIE_FILE)
+
+    # the first date is fetched on its own so that any login happens once;
+    # the remaining dates then share the authenticated session concurrently.
+    # if that login failed, every thread would log in again on the shared
+    # session, so the remaining dates are left for the next poll.
+    fetched = {missing[0]: fetch_fanmatch(session, missing[0])}
+    if fetched[missing[0]] is not None and len(missing) > 1:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = list(map(lambda d: (d, executor.submit(fetch_fanmatch, session, d)), missing[1:]))
+            for day, future in futures:
+                fetched[day] = future.result()
+
+    retrieved = sorted(filter(lambda d: fetched[d] is not None, fetched))
+    if retrieved:
+        print(f'Retrieved KenPom predictions for {", ".join(retrieved)}')
+
+    # a failed fetch is not cached so that the next poll tries again, while
+    # a date without games is cached under the shorter empty ttl
+    for day in missing:
+        events = fetched[day] if day in fetched else None
+        events_by_date[day] = events if events is not None else []
+        if cache is not None and events is not None:
+            cache.put(day, events)
+
+    return events_by_date
+
+def get_kenpom_events(
+    **kwargs) -> List[KenPomEvent]:
+
+    day = str(date.today())
+
+    return get_kenpom_events_by_date([day], **kwargs)[day]
@@ -0,0 +1,645 @@
+import json
+from os import makedirs, path
+import sqlite3
+from typing import List, Tuple
+
+DB_BACKEND_NONE = 'none'
+DB_BACKEND_MONGO = 'mongo'
+DB_BACKEND_SQLITE = 'sqlite'
+DB_BACKENDS = [DB_BACKEND_NONE, DB_BACKEND_MONGO, DB_BACKEND_SQLITE]
+
+# sqlite limits the number of bound parameters in a single statement, so
+# large IN (...) queries are split into chunks of this size.
+SQLITE_MAX_VARIABLES = 500
+
+SQLITE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS events (
+        event_id TEXT PRIMARY KEY,
+        last_updated TEXT,
+        game_date TEXT,
+        game_time TEXT,
+        away_team TEXT,
+        home_team TEXT,
+        betting_choices TEXT,
+        outcome TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS betting_lines (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_id TEXT NOT NULL,
+        lines TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS betting_lines_event_id ON betting_lines (event_id, id)',
+    '''CREATE TABLE IF NOT EXISTS kenpom_predictions (
+        kenpom_id TEXT PRIMARY KEY,
+        game_date TEXT,
+        away_team TEXT,
+        home_team TEXT,
+        prediction TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS kenpom_predictions_game_date ON kenpom_predictions (game_date)',
+    '''CREATE TABLE IF NOT EXISTS clv (
+        event_id TEXT NOT NULL,
+        bet TEXT NOT NULL,
+        away_team TEXT,
+        home_team TEXT,
+        game_date TEXT,
+        placed_at TEXT,
+        placed_line REAL,
+        placed_odds REAL,
+        closing_at TEXT,
+        closing_line REAL,
+        closing_odds REAL,
+        clv_points REAL,
+        clv_expected_value REAL,
+        PRIMARY KEY (event_id, bet)
+    )'''
+]
+
+# columns of the closing line value ledger, in table order
+CLV_COLUMNS = [
+    'event_id',
+    'bet',
+    'away_team',
+    'home_team',
+    'game_date',
+    'placed_at',
+    'placed_line',
+    'placed_odds',
+    'closing_at',
+    'closing_line',
+    'closing_odds',
+    'clv_points',
+    'clv_expected_value'
+]
+
+def find_kenpom_ids(
+    documents: List[dict]) -> List[str]:
+
+    ids = set()
+    for document in documents:
+        for lines in document['betting_lines']:
+            if 'kenpom_id' in lines:
+                ids.add(lines['kenpom_id'])
+
+    return list(ids)
+
+def resolve_kenpom_predictions(
+    documents: List[dict],
+    predictions: dict) -> None:
+
+    # snapshots refer to their prediction by id; the prediction is put back
+    # in place so that hydration reads it like an embedded one
+    for document in documents:
+        for lines in document['betting_lines']:
+            if 'kenpom_id' in lines and lines['kenpom_id'] in predictions:
+                lines['kenpom_event'] = predictions[lines['kenpom_id']]
+
+    return
+
+def create_empty_event_document(
+    event_id: str) -> dict:
+
+    d = {
+        'event_id': event_id,
+        'last_updated': '',
+        'game_date': '',
+        'game_time': '',
+        'away_team': '',
+        'home_team': '',
+        'betting_lines': [],
+        'betting_choices': {},
+        'outcome': {}
+    }
+
+    return d
+
+
+class MongoEventStore:
+    '''Event persistence backed by a MongoDB database.'''
+
+    __slots__ = [
+        'database'
+    ]
+
+    def __init__(
+        self,
+        database):
+
+        self.database = database
+        self.database.events.create_index('event_id', unique = True)
+        self.database.clv.create_index([('event_id', 1), ('bet', 1)], unique = True)
+        self.database.kenpom_predictions.create_index('kenpom_id', unique = True)
+        self.database.kenpom_predictions.create_index('game_date')
+
+        return
+
+    def find_event(
+        self,
+        event_id: str) -> dict:
+
+        return self.database.events.find_one({'event_id': event_id})
+
+    def find_events(
+        self,
+        event_ids: List[str]) -> dict:
+
+        found = {}
+        for document in self.database.events.find({'event_id': {'$in': event_ids}}):
+            found[document['event_id']] = document
+
+        resolve_kenpom_predictions(
+            list(found.values()),
+            self.find_kenpom_predictions(find_kenpom_ids(list(found.values()))))
+
+        return found
+
+    def find_all_events(
+        self) -> List[dict]:
+
+        documents = list(self.database.events.find({}))
+        resolve_kenpom_predictions(documents, self.find_kenpom_predictions(None))
+
+        return documents
+
+    def find_kenpom_predictions(
+        self,
+        kenpom_ids: List[str]) -> dict:
+
+        if kenpom_ids is not None and not kenpom_ids:
+            return {}
+
+        # every prediction when no ids are given
+        query = {'kenpom_id': {'$in': kenpom_ids}} if kenpom_ids is not None else {}
+
+        found = {}
+        for prediction in self.database.kenpom_predictions.find(query, {'_id': 0}):
+            found[prediction.pop('kenpom_id')] = prediction
+
+        return found
+
+    def upsert_kenpom_predictions(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        from pymongo import UpdateOne
+
+        requests = []
+        for kenpom_id, prediction in updates:
+            requests.append(UpdateOne(
+                {
+                    'kenpom_id': kenpom_id
+                },
+                {
+                    '$set': prediction
+                },
+                upsert = True
+            ))
+
+        self.database.kenpom_predictions.bulk_write(requests, ordered = False)
+
+        return
+
+    def create_events(
+        self,
+        documents: List[dict]) -> None:
+
+        if not documents:
+            return
+
+        from pymongo import UpdateOne
+
+        # only insert documents that do not exist yet; existing documents
+        # (and their line history) are left untouched.
+        requests = []
+        for document in documents:
+            requests.append(UpdateOne(
+                {
+                    'event_id': document['event_id']
+                },
+                {
+                    '$setOnInsert': document
+                },
+                upsert = True
+            ))
+
+        self.database.events.bulk_write(requests, ordered = False)
+
+        return
+
+    def push_betting_lines(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        from pymongo import UpdateOne
+
+        requests = []
+        for event_id, lines in updates:
+            requests.append(UpdateOne(
+                {
+                    'event_id': event_id
+                },
+                {
+                    '$push': {
+                        'betting_lines': lines
+                    }
+                }
+            ))
+
+        self.database.events.bulk_write(requests, ordered = False)
+
+        return
+
+    def set_betting_choices(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        from pymongo import UpdateOne
+
+        requests = []
+        for event_id, choices in updates:
+            requests.append(UpdateOne(
+                {
+                    'event_id': event_id
+                },
+                {
+                    '$set': {
+                        'betting_choices': choices
+                    }
+                }
+            ))
+
+        self.database.events.bulk_write(requests, ordered = False)
+
+        return
+
+    def set_outcomes(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        from pymongo import UpdateOne
+
+        requests = []
+        for event_id, outcome in updates:
+            requests.append(UpdateOne(
+                {
+                    'event_id': event_id
+                },
+                {
+                    '$set': {
+                        'outcome': outcome
+                    }
+                }
+            ))
+
+        self.database.events.bulk_write(requests, ordered = False)
+
+        return
+
+    def find_clv_entries(
+        self) -> List[dict]:
+
+        return list(self.database.clv.find({}, {'_id': 0}))
+
+    def upsert_clv_entries(
+        self,
+        entries: List[dict]) -> None:
+
+        if not entries:
+            return
+
+        from pymongo import UpdateOne
+
+        requests = []
+        for entry in entries:
+            requests.append(UpdateOne(
+                {
+                    'event_id': entry['event_id'],
+                    'bet': entry['bet']
+                },
+                {
+                    '$set': entry
+                },
+                upsert = True
+            ))
+
+        self.database.clv.bulk_write(requests, ordered = False)
+
+        return
+
+
+class SqliteEventStore:
+    '''Event persistence backed by a local SQLite database file.'''
+
+    __slots__ = [
+        'filename',
+        'connection'
+    ]
+
+    def __init__(
+        self,
+        filename: str):
+
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+
+        # write-ahead logging lets readers (analytics, reports) run while a
+        # poll is writing, and normal sync is durable enough for line data.
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+
+        with self.connection:
+            for statement in SQLITE_SCHEMA:
+                self.connection.execute(statement)
+
+        return
+
+    def create_document_from_row(
+        self,
+        row: tuple) -> dict:
+
+        document = create_empty_event_document(row[0])
+        document['last_updated'] = row[1]
+        document['game_date'] = row[2]
+        document['game_time'] = row[3]
+        document['away_team'] = row[4]
+        document['home_team'] = row[5]
+        document['betting_choices'] = json.loads(row[6]) if row[6] else {}
+        document['outcome'] = json.loads(row[7]) if row[7] else {}
+
+        return document
+
+    def find_event(
+        self,
+        event_id: str) -> dict:
+
+        found = self.find_events([event_id])
+
+        return found[event_id] if event_id in found else None
+
+    def find_events(
+        self,
+        event_ids: List[str]) -> dict:
+
+        found = {}
+        for i in range(0, len(event_ids), SQLITE_MAX_VARIABLES):
+            chunk = event_ids[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' for _ in chunk)
+
+            rows = self.connection.execute(
+                f'SELECT event_id, last_updated, game_date, game_time, away_team, home_team, betting_choices, outcome FROM events WHERE event_id IN ({placeholders})',
+                chunk)
+
+            for row in rows:
+                found[row[0]] = self.create_document_from_row(row)
+
+            rows = self.connection.execute(
+                f'SELECT event_id, lines FROM betting_lines WHERE event_id IN ({placeholders}) ORDER BY event_id, id',
+                chunk)
+
+            for row in rows:
+                if row[0] in found:
+                    found[row[0]]['betting_lines'].append(json.loads(row[1]))
+
+        resolve_kenpom_predictions(
+            list(found.values()),
+            self.find_kenpom_predictions(find_kenpom_ids(list(found.values()))))
+
+        return found
+
+    def find_all_events(
+        self) -> List[dict]:
+
+        # one scan of each table; the line history is streamed in event order
+        # and attached to the events it belongs to.
+        found = {}
+        rows = self.connection.execute(
+            'SELECT event_id, last_updated, game_date, game_time, away_team, home_team, betting_choices, outcome FROM events')
+        for row in rows:
+            found[row[0]] = self.create_document_from_row(row)
+
+        rows = self.connection.execute('SELECT event_id, lines FROM betting_lines ORDER BY event_id, id')
+        for row in rows:
+            if row[0] in found:
+                found[row[0]]['betting_lines'].append(json.loads(row[1]))
+
+        documents = list(found.values())
+        resolve_kenpom_predictions(documents, self.find_kenpom_predictions(None))
+
+        return documents
+
+    def find_kenpom_predictions(
+        self,
+        kenpom_ids: List[str]) -> dict:
+
+        # every prediction when no ids are given, in a single scan
+        if kenpom_ids is None:
+            rows = self.connection.execute('SELECT kenpom_id, prediction FROM kenpom_predictions')
+            return dict(map(lambda row: (row[0], json.loads(row[1])), rows))
+
+        found = {}
+        for i in range(0, len(kenpom_ids), SQLITE_MAX_VARIABLES):
+            chunk = kenpom_ids[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' for _ in chunk)
+
+            rows = self.connection.execute(
+                f'SELECT kenpom_id, prediction FROM kenpom_predictions WHERE kenpom_id IN ({placeholders})',
+                chunk)
+
+            for row in rows:
+                found[row[0]] = json.loads(row[1])
+
+        return found
+
+    def upsert_kenpom_predictions(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        values = list(map(lambda u: (
+            u[0],
+            u[1]['game_date'] if 'game_date' in u[1] else '',
+            u[1]['away_team'] if 'away_team' in u[1] else '',
+            u[1]['home_team'] if 'home_team' in u[1] else '',
+            json.dumps(u[1])), updates))
+
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO kenpom_predictions (kenpom_id, game_date, away_team, home_team, prediction) VALUES (?, ?, ?, ?, ?)',
+                values)
+
+        return
+
+    def create_events(
+        self,
+        documents: List[dict]) -> None:
+
+        if not documents:
+            return
+
+        values = []
+        for document in documents:
+            values.append((
+                document['event_id'],
+                document['last_updated'],
+                document['game_date'],
+                document['game_time'],
+                document['away_team'],
+                document['home_team'],
+                json.dumps(document['betting_choices']),
+                json.dumps(document['outcome'])
+            ))
+
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO events (event_id, last_updated, game_date, game_time, away_team, home_team, betting_choices, outcome) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                values)
+
+        return
+
+    def push_betting_lines(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        values = list(map(lambda u: (u[0], json.dumps(u[1])), updates))
+
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO betting_lines (event_id, lines) VALUES (?, ?)',
+                values)
+
+        return
+
+    def set_betting_choices(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        values = list(map(lambda u: (json.dumps(u[1]), u[0]), updates))
+
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE events SET betting_choices = ? WHERE event_id = ?',
+                values)
+
+        return
+
+    def set_outcomes(
+        self,
+        updates: List[Tuple[str, dict]]) -> None:
+
+        if not updates:
+            return
+
+        values = list(map(lambda u: (json.dumps(u[1]), u[0]), updates))
+
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE events SET outcome = ? WHERE event_id = ?',
+                values)
+
+        return
+
+    def find_clv_entries(
+        self) -> List[dict]:
+
+        rows = self.connection.execute(f'SELECT {", ".join(CLV_COLUMNS)} FROM clv')
+
+        return list(map(lambda row: dict(zip(CLV_COLUMNS, row)), rows))
+
+    def upsert_clv_entries(
+        self,
+        entries: List[dict]) -> None:
+
+        if not entries:
+            return
+
+        values = list(map(lambda e: tuple(map(lambda c: e[c], CLV_COLUMNS)), entries))
+        placeholders = ', '.join('?' for _ in CLV_COLUMNS)
+
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO clv ({", ".join(CLV_COLUMNS)}) VALUES ({placeholders})',
+                values)
+
+        return
+
+
+class MongoEventClient:
+    '''Hands out MongoEventStores for named databases on a single server.'''
+
+    __slots__ = [
+        'client'
+    ]
+
+    def __init__(
+        self,
+        host: str):
+
+        # pymongo is only imported when the mongo backend is selected
+        from pymongo import MongoClient
+
+        self.client = MongoClient(host)
+
+        return
+
+    def get_database(
+        self,
+        database_name: str) -> MongoEventStore:
+
+        return MongoEventStore(self.client.get_database(database_name))
+
+
+class SqliteEventClient:
+    '''Hands out SqliteEventStores, one database file per name.'''
+
+    __slots__ = [
+        'directory'
+    ]
+
+    def __init__(
+        self,
+        directory: str):
+
+        self.directory = directory
+
+        return
+
+    def get_database(
+        self,
+        database_name: str) -> SqliteEventStore:
+
+        makedirs(self.directory, exist_ok = True)
+
+        return SqliteEventStore(path.join(self.directory, f'{database_name}.sqlite3'))
+
+
+def create_client(
+    backend: str,
+    **kwargs):
+
+    if backend == DB_BACKEND_MONGO:
+        return MongoEventClient(kwargs['host'] if 'host' in kwargs else 'localhost')
+
+    if backend == DB_BACKEND_SQLITE:
+        return SqliteEventClient(kwargs['directory'] if 'directory' in kwargs else '.')
+
+    return None
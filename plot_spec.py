@@ -0,0 +1,123 @@
+import json
+import math
+from typing import List
+import uuid
+
+# the plotly layout template, the script tags that load plotly from the cdn
+# and the div/script wrapper never change between charts, so they are built
+# once per process and every chart is spliced into them instead of being
+# rebuilt and validated as a go.Figure.
+PLOT_TEMPLATE_CACHE = {}
+
+PLOT_DIV_ID_PLACEHOLDER = 'REPLACE_DIV_ID'
+PLOT_DATA_PLACEHOLDER = 'REPLACE_DATA'
+PLOT_LAYOUT_PLACEHOLDER = 'REPLACE_LAYOUT'
+
+# characters escaped in the json so that it is safe to embed in a script
+# tag; this matches the escaping plotly applies.
+PLOT_JSON_ESCAPES = [
+    ('<', '\\u003c'),
+    ('>', '\\u003e'),
+    ('/', '\\u002f'),
+    ('\u2028', '\\u2028'),
+    ('\u2029', '\\u2029')
+]
+
+def to_finite(
+    value):
+
+    # plotly writes nan and infinity as null, json.dumps as bare NaN and
+    # Infinity, which is not json
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    elif isinstance(value, dict):
+        return {k: to_finite(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return list(map(to_finite, value))
+
+    return value
+
+def to_json(
+    value) -> str:
+
+    encoded = json.dumps(to_finite(value), separators = (',', ':'), ensure_ascii = False, allow_nan = False)
+    for character, escaped in PLOT_JSON_ESCAPES:
+        encoded = encoded.replace(character, escaped)
+
+    return encoded
+
+def load_plot_template() -> dict:
+
+    if PLOT_TEMPLATE_CACHE:
+        return PLOT_TEMPLATE_CACHE
+
+    import plotly.graph_objects as go
+    from plotly.io.json import to_json_plotly
+
+    # render an empty figure once and turn it into a template: the header
+    # (plotly config and cdn script), the div/script wrapper and the default
+    # layout template all come straight from the installed plotly.
+    figure = go.Figure()
+    skeleton = figure.to_html(
+        full_html = False,
+        include_plotlyjs = 'cdn',
+        div_id = PLOT_DIV_ID_PLACEHOLDER)
+
+    layout_template = to_json_plotly(figure.to_dict()['layout']['template'])
+    header_end = skeleton.index(f'<div id="{PLOT_DIV_ID_PLACEHOLDER}"')
+
+    body = skeleton[header_end:]
+    body = body.replace(f'{{"template":{layout_template}}}', PLOT_LAYOUT_PLACEHOLDER, 1)
+    body = body.replace('[],', f'{PLOT_DATA_PLACEHOLDER},', 1)
+
+    PLOT_TEMPLATE_CACHE['header'] = skeleton[:header_end]
+    PLOT_TEMPLATE_CACHE['body'] = body
+    PLOT_TEMPLATE_CACHE['layout_template'] = layout_template
+
+    return PLOT_TEMPLATE_CACHE
+
+def create_scatter_trace(
+    x_data: List,
+    y_data: List,
+    name: str,
+    step: bool) -> dict:
+
+    # key order matches what plotly produces for the equivalent go.Scatter
+    trace = {}
+    if step:
+        trace['line'] = {'shape': 'hv'}
+    trace['mode'] = 'lines+markers' if step else 'lines'
+    trace['name'] = name
+    trace['x'] = x_data
+    trace['y'] = y_data
+    trace['type'] = 'scatter'
+
+    return trace
+
+def create_plot_html(
+    x_data: List,
+    y_data: List,
+    x_label: str,
+    y_label: str,
+    title: str,
+    fixed_y: float,
+    fixed_y_label: str) -> str:
+
+    template = load_plot_template()
+
+    data = [create_scatter_trace(x_data, y_data, y_label, True)]
+    if fixed_y is not None:
+        data.append(create_scatter_trace(x_data, [fixed_y for _ in range(len(x_data))], fixed_y_label, False))
+
+    layout = to_json({
+        'title': {'text': title},
+        'xaxis': {'title': {'text': x_label}},
+        'yaxis': {'title': {'text': y_label}}
+    })
+    layout = f'{layout[:-1]},"template":{template["layout_template"]}}}'
+
+    body = template['body'].replace(PLOT_DIV_ID_PLACEHOLDER, str(uuid.uuid4()))
+    body = body.replace(PLOT_DATA_PLACEHOLDER, to_json(data), 1)
+    body = body.replace(PLOT_LAYOUT_PLACEHOLDER, layout, 1)
+
+    return f'{template["header"]}{body}'
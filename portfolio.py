@@ -0,0 +1,148 @@
+import numpy as np
+from typing import Dict, List, Tuple
+
+import kelly
+
+# number of sampled slate outcomes the expected log growth is averaged over
+PORTFOLIO_SCENARIOS = 4000
+PORTFOLIO_SEED = 0
+
+PORTFOLIO_MAX_ITERATIONS = 500
+PORTFOLIO_TOLERANCE = 1e-7
+
+# stakes are written to the sheet as a fraction of the bankroll
+PORTFOLIO_STAKE_DIGITS = 4
+
+def project_to_capped_simplex(
+    stakes: np.ndarray,
+    cap: float) -> np.ndarray:
+
+    # euclidean projection onto {f >= 0, sum(f) <= cap}
+    stakes = np.maximum(stakes, 0)
+    if stakes.sum() <= cap:
+        return stakes
+
+    ordered = np.sort(stakes)[::-1]
+    cumulative = np.cumsum(ordered) - cap
+    rho = np.nonzero(ordered - cumulative / np.arange(1, len(ordered) + 1) > 0)[0][-1]
+    theta = cumulative[rho] / (rho + 1)
+
+    return np.maximum(stakes - theta, 0)
+
+def create_scenario_returns(
+    games: np.ndarray,
+    sides: np.ndarray,
+    probabilities: np.ndarray,
+    decimal_odds: np.ndarray,
+    scenarios: int,
+    seed: int) -> np.ndarray:
+
+    # one uniform draw per game and scenario, shared by both sides of the
+    # game so that they can never both win: the away side wins below its
+    # probability and the home side wins above one minus its probability.
+    rng = np.random.default_rng(seed)
+    draws = rng.random((scenarios, games.max() + 1))[:, games]
+
+    wins = np.where(
+        sides == kelly.AWAY,
+        draws < probabilities,
+        draws >= 1 - probabilities)
+
+    return np.where(wins, decimal_odds - 1, -1.0)
+
+def expected_log_growth(
+    returns: np.ndarray,
+    stakes: np.ndarray) -> float:
+
+    return float(np.log1p(returns @ stakes).mean())
+
+def optimize_stakes(
+    returns: np.ndarray,
+    initial_stakes: np.ndarray,
+    cap: float,
+    **kwargs) -> np.ndarray:
+
+    max_iterations = kwargs['max_iterations'] if 'max_iterations' in kwargs else PORTFOLIO_MAX_ITERATIONS
+    tolerance = kwargs['tolerance'] if 'tolerance' in kwargs else PORTFOLIO_TOLERANCE
+
+    # projected gradient ascent on the sample average of log wealth. with the
+    # total stake capped below the bankroll every scenario keeps positive
+    # wealth, so the objective is always defined.
+    stakes = project_to_capped_simplex(initial_stakes, cap)
+    growth = expected_log_growth(returns, stakes)
+    step = 1.0
+
+    for _ in range(max_iterations):
+        gradient = (returns / (1 + returns @ stakes)[:, None]).mean(axis = 0)
+
+        # backtrack until the step gives sufficient ascent
+        while True:
+            candidate = project_to_capped_simplex(stakes + step * gradient, cap)
+            difference = candidate - stakes
+            candidate_growth = expected_log_growth(returns, candidate)
+            if candidate_growth >= growth + gradient @ difference - (difference @ difference) / (2 * step) or step < 1e-12:
+                break
+            step /= 2
+
+        stakes = candidate
+        growth = candidate_growth
+        step *= 2
+
+        if np.sqrt(difference @ difference) < tolerance:
+            break
+
+    return stakes
+
+def optimize_event_group(
+    events: List,
+    cap: float,
+    **kwargs) -> Dict[str, Tuple[float, float]]:
+
+    scenarios = kwargs['scenarios'] if 'scenarios' in kwargs else PORTFOLIO_SCENARIOS
+    seed = kwargs['seed'] if 'seed' in kwargs else PORTFOLIO_SEED
+
+    if cap >= 1:
+        raise ValueError('The portfolio cap must be less than the full bankroll.')
+
+    slate_kelly = kelly.SlateKelly(events)
+
+    # every side with a positive individual kelly on its latest snapshot is a
+    # candidate; in-progress events can no longer be bet.
+    stakes = {}
+    candidates = []
+    for game, slate_event in enumerate(events):
+        start, end = slate_kelly.offsets[slate_event.event_id]
+        if start == end or not slate_event.betting_lines[-1].kenpom_event:
+            continue
+
+        stakes[slate_event.event_id] = [0.0, 0.0]
+        if slate_event.in_progress:
+            continue
+
+        for side in (kelly.AWAY, kelly.HOME):
+            if slate_kelly.kelly[end - 1, side] > 0:
+                candidates.append((slate_event.event_id, game, side, end - 1))
+
+    if candidates:
+        games = np.array(list(map(lambda c: c[1], candidates)))
+        sides = np.array(list(map(lambda c: c[2], candidates)))
+        snapshots = np.array(list(map(lambda c: c[3], candidates)))
+
+        returns = create_scenario_returns(
+            games,
+            sides,
+            slate_kelly.probability[snapshots, sides],
+            slate_kelly.decimal_odds[snapshots, sides],
+            scenarios,
+            seed)
+
+        optimal = optimize_stakes(
+            returns,
+            slate_kelly.kelly[snapshots, sides],
+            cap,
+            **kwargs)
+
+        for candidate, stake in zip(candidates, optimal.tolist()):
+            stakes[candidate[0]][candidate[2]] = round(stake, PORTFOLIO_STAKE_DIGITS)
+
+    return dict(map(lambda item: (item[0], tuple(item[1])), stakes.items()))
@@ -0,0 +1,101 @@
+from datetime import date, datetime
+from typing import List, Tuple
+
+import numpy as np
+
+import kenpom
+
+# adjusted efficiencies are scaled up for the home team and down for the
+# visitor; both sides together are worth about 3.5 points a game
+RATINGS_HOME_ADVANTAGE = 0.012
+
+# pythagorean exponent turning offense and defense into a win expectancy
+RATINGS_EXPONENT = 11.5
+
+# fanmatch confidences are whole percentages and never reach certainty,
+# which would otherwise size a kelly stake at the whole bankroll
+RATINGS_CONFIDENCE_DIGITS = 2
+RATINGS_MAX_CONFIDENCE = 0.99
+
+
+class TeamRatings:
+    '''Adjusted offense, defense and tempo of every rated team.'''
+
+    __slots__ = [
+        'teams',
+        'offense',
+        'defense',
+        'tempo',
+        'average_efficiency',
+        'average_tempo'
+    ]
+
+    def __init__(
+        self,
+        ratings: List[dict]):
+
+        # team -> row of the rating arrays
+        self.teams = dict(map(lambda r: (r[1]['team'], r[0]), enumerate(ratings)))
+        self.offense = np.array(list(map(lambda r: r['offense'], ratings)), dtype = float)
+        self.defense = np.array(list(map(lambda r: r['defense'], ratings)), dtype = float)
+        self.tempo = np.array(list(map(lambda r: r['tempo'], ratings)), dtype = float)
+
+        # national averages every matchup is scaled by
+        self.average_efficiency = self.offense.mean() if len(ratings) else np.nan
+        self.average_tempo = self.tempo.mean() if len(ratings) else np.nan
+
+        return
+
+    def contains_team(
+        self,
+        team: str) -> bool:
+
+        return team in self.teams
+
+def predict_games(
+    ratings: TeamRatings,
+    games: List[Tuple[str, str, str]]) -> List[kenpom.KenPomEvent]:
+
+    # games are (game date, away team, home team); a game with an unrated
+    # team gets no prediction.
+    predictions = [None] * len(games)
+    rated = list(filter(lambda i: ratings.contains_team(games[i][1]) and ratings.contains_team(games[i][2]), range(len(games))))
+    if not rated:
+        return predictions
+
+    away = np.array(list(map(lambda i: ratings.teams[games[i][1]], rated)))
+    home = np.array(list(map(lambda i: ratings.teams[games[i][2]], rated)))
+
+    # every game is computed at once from the two teams' rating rows
+    home_offense = ratings.offense[home] * (1 + RATINGS_HOME_ADVANTAGE)
+    home_defense = ratings.defense[home] * (1 - RATINGS_HOME_ADVANTAGE)
+    away_offense = ratings.offense[away] * (1 - RATINGS_HOME_ADVANTAGE)
+    away_defense = ratings.defense[away] * (1 + RATINGS_HOME_ADVANTAGE)
+
+    possessions = ratings.tempo[away] * ratings.tempo[home] / ratings.average_tempo
+    home_score = home_offense * away_defense / ratings.average_efficiency * possessions / 100
+    away_score = away_offense * home_defense / ratings.average_efficiency * possessions / 100
+
+    # log5 of the two pythagorean win expectancies
+    home_expectancy = home_offense ** RATINGS_EXPONENT / (home_offense ** RATINGS_EXPONENT + home_defense ** RATINGS_EXPONENT)
+    away_expectancy = away_offense ** RATINGS_EXPONENT / (away_offense ** RATINGS_EXPONENT + away_defense ** RATINGS_EXPONENT)
+    home_probability = (home_expectancy - home_expectancy * away_expectancy) / (home_expectancy + away_expectancy - 2 * home_expectancy * away_expectancy)
+
+    last_updated = f'{date.today()} {datetime.now().strftime("%H:%M:%S")}'
+    for i, probability, home_points, away_points in zip(rated, home_probability.tolist(), np.rint(home_score).tolist(), np.rint(away_score).tolist()):
+        game_date, away_team, home_team = games[i]
+        home_wins = probability >= 0.5
+
+        # filled in the shape of a fanmatch row, winner's score first
+        prediction = kenpom.KenPomEvent()
+        prediction.last_updated = last_updated
+        prediction.game_date = game_date
+        prediction.away_team = away_team
+        prediction.home_team = home_team
+        prediction.winning_team = home_team if home_wins else away_team
+        prediction.score = f'{int(home_points)}-{int(away_points)}' if home_wins else f'{int(away_points)}-{int(home_points)}'
+        prediction.confidence = min(round(probability if home_wins else 1 - probability, RATINGS_CONFIDENCE_DIGITS), RATINGS_MAX_CONFIDENCE)
+        prediction.source = kenpom.KP_SOURCE_RATINGS
+        predictions[i] = prediction
+
+    return predictions
@@ -0,0 +1,314 @@
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import hashlib
+import json
+from os import makedirs, path, replace
+import shutil
+from typing import List
+
+import downsample
+
+REPORT_DEFAULT_DIRECTORY = './plots'
+REPORT_MANIFEST_FILE = 'manifest.json'
+
+SLATE_MODE_NONE = 'none'
+SLATE_MODE_FULL = 'full'
+SLATE_MODE_APPEND = 'append'
+SLATE_MODES = [SLATE_MODE_NONE, SLATE_MODE_FULL, SLATE_MODE_APPEND]
+
+SLATE_DATA_FILE = 'slate.json'
+SLATE_UPDATES_FILE = 'slate.updates.jsonl'
+SLATE_INDEX_FILE = 'slate.index.json'
+SLATE_DASHBOARD_FILE = 'index.html'
+SLATE_DASHBOARD_TEMPLATE = path.join(path.dirname(path.abspath(__file__)), 'dashboard.html')
+
+# one column per charted series; every event stores its history as one list
+# per column rather than one object per snapshot.
+SLATE_COLUMNS = [
+    'last_updated',
+    'away_team_spread',
+    'home_team_spread',
+    'away_team_moneyline',
+    'home_team_moneyline',
+    'over_under',
+    'away_kelly',
+    'home_kelly'
+]
+
+def create_kenpom_content(
+    kenpom_event) -> dict:
+
+    if not kenpom_event:
+        return None
+
+    content = kenpom_event.create_mongodb_dict()
+    del content['last_updated']
+
+    return content
+
+def create_report_hash(
+    report_event) -> str:
+
+    # everything that is drawn in the report: the matchup header, the full
+    # line history (including kenpom) and the betting choices. the lines only
+    # carry a reference to their kenpom prediction, so the prediction itself
+    # is hashed too, less the time it was last read.
+    content = [
+        report_event.event_id,
+        report_event.away_team,
+        report_event.home_team,
+        report_event.game_date,
+        report_event.game_time,
+        list(map(lambda x: [x.create_mongodb_dict(), create_kenpom_content(x.kenpom_event)], report_event.betting_lines)),
+        report_event.betting_choices.create_mongodb_dict()
+    ]
+
+    return hashlib.sha256(json.dumps(content, sort_keys = True, default = str).encode('utf-8')).hexdigest()
+
+def load_report_manifest(
+    output_directory: str) -> dict:
+
+    filename = path.join(output_directory, REPORT_MANIFEST_FILE)
+    if not path.exists(filename):
+        return {}
+
+    try:
+        with open(filename, 'r') as f:
+            manifest = json.load(f)
+    except ValueError:
+        return {}
+
+    return manifest
+
+def write_report_manifest(
+    output_directory: str,
+    manifest: dict) -> None:
+
+    # write to a temporary file first so an interrupted run never leaves a
+    # truncated manifest behind.
+    filename = path.join(output_directory, REPORT_MANIFEST_FILE)
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+
+    replace(f'{filename}.tmp', filename)
+
+    return
+
+def create_report_filename(
+    output_directory: str,
+    group_name: str,
+    event_id: str) -> str:
+
+    return path.join(output_directory, group_name, f'{event_id}.html')
+
+def render_event_report(
+    report_event,
+    filename: str) -> str:
+
+    report_event.write_html(filename)
+
+    return filename
+
+def write_event_reports(
+    event_groups: List,
+    output_directory: str,
+    max_workers: int) -> int:
+
+    manifest = load_report_manifest(output_directory)
+
+    jobs = []
+    hashes = {}
+    skipped = 0
+    for event_group in event_groups:
+        makedirs(path.join(output_directory, event_group.database_name), exist_ok = True)
+
+        for group_event in event_group.events:
+            if not group_event.betting_lines:
+                continue
+
+            filename = create_report_filename(
+                output_directory,
+                event_group.database_name,
+                group_event.event_id)
+
+            # skip events whose history and choices are unchanged since the
+            # report was last written
+            key = f'{event_group.database_name}/{group_event.event_id}'
+            report_hash = create_report_hash(group_event)
+            if key in manifest and manifest[key] == report_hash and path.exists(filename):
+                skipped += 1
+                continue
+
+            jobs.append((group_event.create_report_copy(), filename))
+            hashes[key] = report_hash
+
+    if not jobs:
+        print(f'All {skipped} event reports are up to date: {output_directory}')
+        return 0
+
+    # rendering is cpu-bound (chart spec serialization), so spread
+    # the events across processes. a single worker renders inline to avoid
+    # the pool overhead on small machines.
+    if max_workers == 1:
+        for report_event, filename in jobs:
+            render_event_report(report_event, filename)
+    else:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            futures = list(map(lambda j: executor.submit(render_event_report, j[0], j[1]), jobs))
+            for future in futures:
+                future.result()
+
+    manifest.update(hashes)
+    write_report_manifest(output_directory, manifest)
+
+    print(f'Wrote {len(jobs)} event reports ({skipped} unchanged) to: {output_directory}')
+
+    return len(jobs)
+
+def create_slate_columns(
+    slate_event,
+    start: int,
+    max_points: int,
+    slate_kelly) -> List[list]:
+
+    import kelly
+
+    away_kellys = slate_kelly.history(slate_event.event_id, kelly.AWAY).tolist()
+    home_kellys = slate_kelly.history(slate_event.event_id, kelly.HOME).tolist()
+
+    columns = list(map(lambda _: [], SLATE_COLUMNS))
+    for i in range(start, len(slate_event.betting_lines)):
+        lines = slate_event.betting_lines[i]
+        columns[0].append(lines.last_updated)
+        columns[1].append(lines.away_team_spread)
+        columns[2].append(lines.home_team_spread)
+        columns[3].append(lines.away_team_moneyline)
+        columns[4].append(lines.home_team_moneyline)
+        columns[5].append(lines.over_under)
+        columns[6].append(away_kellys[i] if lines.kenpom_event else None)
+        columns[7].append(home_kellys[i] if lines.kenpom_event else None)
+
+    # the columns share timestamps, so a snapshot is kept whenever any of
+    # the series needs it after downsampling.
+    keep = set()
+    for column in columns[1:]:
+        keep.update(downsample.downsample_indices(columns[0], column, max_points))
+    keep = sorted(keep)
+
+    if len(keep) == len(columns[0]):
+        return columns
+
+    return list(map(lambda column: list(map(lambda i: column[i], keep)), columns))
+
+def create_slate_event(
+    group_name: str,
+    slate_event) -> dict:
+
+    d = {
+        'key': f'{group_name}/{slate_event.event_id}',
+        'group': group_name,
+        'event_id': slate_event.event_id,
+        'away_team': slate_event.away_team,
+        'home_team': slate_event.home_team,
+        'game_date': slate_event.game_date,
+        'game_time': slate_event.game_time,
+        'url': slate_event.create_event_url(),
+        'bets': slate_event.betting_choices.create_mongodb_dict()
+    }
+
+    return d
+
+def load_slate_index(
+    output_directory: str) -> dict:
+
+    filename = path.join(output_directory, SLATE_INDEX_FILE)
+    if not path.exists(path.join(output_directory, SLATE_DATA_FILE)) or not path.exists(filename):
+        return None
+
+    try:
+        with open(filename, 'r') as f:
+            index = json.load(f)
+    except ValueError:
+        return None
+
+    return index
+
+def write_slate_data(
+    event_groups: List,
+    output_directory: str,
+    mode: str,
+    max_points: int = downsample.DOWNSAMPLE_MAX_POINTS) -> int:
+
+    if mode == SLATE_MODE_NONE:
+        return 0
+
+    # numpy is only imported once the slate is actually exported
+    import kelly
+
+    makedirs(output_directory, exist_ok = True)
+
+    # append mode needs to know how many snapshots of each event have already
+    # been exported; without that we fall back to a full export.
+    index = load_slate_index(output_directory) if mode == SLATE_MODE_APPEND else None
+    if index is None:
+        mode = SLATE_MODE_FULL
+        index = {}
+
+    generated = f'{datetime.date.today()} {datetime.datetime.now().strftime("%H:%M:%S")}'
+    separators = (',', ':')
+
+    records = []
+    snapshots = 0
+    for event_group in event_groups:
+        # kelly values for the whole group are computed in one batched pass
+        slate_kelly = kelly.SlateKelly(event_group.events)
+
+        for slate_event in event_group.events:
+            if not slate_event.betting_lines:
+                continue
+
+            record = create_slate_event(event_group.database_name, slate_event)
+            start = index[record['key']] if record['key'] in index else 0
+            if start >= len(slate_event.betting_lines):
+                # nothing new to append; the next full export refreshes the
+                # event's details (such as bet markers) as well.
+                continue
+
+            record['data'] = create_slate_columns(slate_event, start, max_points, slate_kelly)
+
+            index[record['key']] = len(slate_event.betting_lines)
+            snapshots += len(record['data'][0])
+            records.append(record)
+
+    if mode == SLATE_MODE_FULL:
+        slate = {
+            'generated': generated,
+            'columns': SLATE_COLUMNS,
+            'events': records
+        }
+
+        # the full export replaces the data file and starts a fresh update log
+        filename = path.join(output_directory, SLATE_DATA_FILE)
+        with open(f'{filename}.tmp', 'w') as f:
+            json.dump(slate, f, separators = separators)
+        replace(f'{filename}.tmp', filename)
+
+        with open(path.join(output_directory, SLATE_UPDATES_FILE), 'w') as f:
+            pass
+    else:
+        # each run appends one line per event holding only the new snapshots;
+        # the dashboard concatenates them onto the base export.
+        with open(path.join(output_directory, SLATE_UPDATES_FILE), 'a') as f:
+            for record in records:
+                record['generated'] = generated
+                f.write(json.dumps(record, separators = separators))
+                f.write('\n')
+
+    with open(path.join(output_directory, SLATE_INDEX_FILE), 'w') as f:
+        json.dump(index, f, separators = separators)
+
+    shutil.copyfile(SLATE_DASHBOARD_TEMPLATE, path.join(output_directory, SLATE_DASHBOARD_FILE))
+
+    print(f'Exported {snapshots} snapshots for {len(records)} events ({mode}) to: {path.join(output_directory, SLATE_DASHBOARD_FILE)}')
+
+    return snapshots
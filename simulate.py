@@ -0,0 +1,298 @@
+#!/usr/bin/python3 -u
+
+import argparse
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+import backtest
+import event
+import kelly
+import persistence
+
+SIMULATE_DEFAULT_PATHS = 1000000
+SIMULATE_DEFAULT_SEED = 0
+SIMULATE_DEFAULT_MIN_KELLY = 0.0
+SIMULATE_DEFAULT_MULTIPLIER = 0.5
+SIMULATE_DEFAULT_MAX_STAKE = 0.5
+
+# a path is ruined once its bankroll falls below this fraction of the start
+SIMULATE_DEFAULT_RUIN_LEVEL = 0.5
+
+# paths are simulated in chunks small enough for the per-path state to stay
+# in cache; memory does not grow with the number of bets.
+SIMULATE_CHUNK_PATHS = 16384
+
+SIMULATE_PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+
+class SimulationBets:
+    '''The probability, odds and bankroll fraction of every bet in a season.'''
+
+    __slots__ = [
+        'probability',
+        'decimal_odds',
+        'stakes'
+    ]
+
+    def __init__(
+        self,
+        events: List[event.SingleEvent],
+        snapshot: str,
+        min_kelly: float,
+        multiplier: float,
+        max_stake: float):
+
+        slate_kelly = kelly.SlateKelly(list(filter(lambda e: e.betting_lines, events)))
+
+        # one bet per side whose kelly value on the chosen snapshot clears
+        # the threshold, staked at a fraction of its kelly value
+        snapshots = []
+        sides = []
+        for start, end in slate_kelly.offsets.values():
+            if start == end:
+                continue
+
+            snapshot_index = start if snapshot == backtest.SNAPSHOT_STARTING else end - 1
+            for side in (kelly.AWAY, kelly.HOME):
+                if slate_kelly.kelly[snapshot_index, side] > max(min_kelly, 0):
+                    snapshots.append(snapshot_index)
+                    sides.append(side)
+
+        self.probability = slate_kelly.probability[snapshots, sides]
+        self.decimal_odds = slate_kelly.decimal_odds[snapshots, sides]
+        self.stakes = np.minimum(multiplier * slate_kelly.kelly[snapshots, sides], max_stake)
+
+        return
+
+
+class SimulationResult:
+    '''Final bankroll, maximum drawdown and ruin flag of every simulated path.'''
+
+    __slots__ = [
+        'final_bankroll',
+        'max_drawdown',
+        'ruined'
+    ]
+
+    def __init__(
+        self,
+        paths: int):
+
+        self.final_bankroll = np.empty(paths)
+        self.max_drawdown = np.empty(paths)
+        self.ruined = np.empty(paths, dtype = bool)
+
+        return
+
+def simulate_chunk(
+    bets: SimulationBets,
+    paths: int,
+    season_bets: int,
+    ruin_level: float,
+    rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+    # each bet either grows the bankroll by stake * (odds - 1) or shrinks it
+    # by the stake, so a path is a running sum of one of two log steps.
+    win_step = np.log1p(bets.stakes * (bets.decimal_odds - 1))
+    loss_step = np.log1p(-bets.stakes)
+    probability = bets.probability.astype(np.float32)
+
+    # walk all paths of the chunk forward one bet at a time, keeping only
+    # the running log bankroll, its peak, the deepest drawdown and the low.
+    log_bankroll = np.zeros(paths)
+    log_peak = np.zeros(paths)
+    log_drawdown = np.zeros(paths)
+    log_low = np.zeros(paths)
+    draws = np.empty(paths, dtype = np.float32)
+    wins = np.empty(paths, dtype = bool)
+    scratch = np.empty(paths)
+
+    for i in range(season_bets if season_bets else len(bets.stakes)):
+        rng.random(out = draws, dtype = np.float32)
+
+        if season_bets:
+            # draw each season's bets from the pool with replacement
+            selected = rng.integers(0, len(bets.stakes), paths)
+            np.less(draws, probability[selected], out = wins)
+            log_bankroll += np.where(wins, win_step[selected], loss_step[selected])
+        else:
+            np.less(draws, probability[i], out = wins)
+            log_bankroll += loss_step[i]
+            np.add(log_bankroll, win_step[i] - loss_step[i], out = log_bankroll, where = wins)
+
+        np.maximum(log_peak, log_bankroll, out = log_peak)
+        np.subtract(log_bankroll, log_peak, out = scratch)
+        np.minimum(log_drawdown, scratch, out = log_drawdown)
+        np.minimum(log_low, log_bankroll, out = log_low)
+
+    return np.exp(log_bankroll), 1 - np.exp(log_drawdown), log_low < np.log(ruin_level)
+
+def simulate(
+    bets: SimulationBets,
+    paths: int,
+    **kwargs) -> SimulationResult:
+
+    seed = kwargs['seed'] if 'seed' in kwargs else SIMULATE_DEFAULT_SEED
+    season_bets = kwargs['season_bets'] if 'season_bets' in kwargs else None
+    ruin_level = kwargs['ruin_level'] if 'ruin_level' in kwargs else SIMULATE_DEFAULT_RUIN_LEVEL
+
+    chunks = list(range(0, paths, SIMULATE_CHUNK_PATHS))
+
+    # every chunk has its own child seed, so a run is reproducible from the
+    # seed alone
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    result = SimulationResult(paths)
+    for start, chunk_seed in zip(chunks, seeds):
+        end = min(start + SIMULATE_CHUNK_PATHS, paths)
+        final_bankroll, max_drawdown, ruined = simulate_chunk(
+            bets,
+            end - start,
+            season_bets,
+            ruin_level,
+            np.random.default_rng(chunk_seed))
+
+        result.final_bankroll[start:end] = final_bankroll
+        result.max_drawdown[start:end] = max_drawdown
+        result.ruined[start:end] = ruined
+
+    return result
+
+def print_result(
+    result: SimulationResult,
+    ruin_level: float) -> None:
+
+    final_bankroll = np.percentile(result.final_bankroll, SIMULATE_PERCENTILES)
+    max_drawdown = np.percentile(result.max_drawdown, SIMULATE_PERCENTILES)
+
+    print(f'{"percentile".ljust(12)} {"bankroll".rjust(10)} {"drawdown".rjust(10)}')
+    for percentile, bankroll, drawdown in zip(SIMULATE_PERCENTILES, final_bankroll, max_drawdown):
+        print(f'{str(percentile).ljust(12)} {bankroll:9.3f}x {drawdown * 100:9.2f}%')
+
+    print(f'Probability of ruin (bankroll below {ruin_level * 100:.0f}%): {result.ruined.mean() * 100:.3f}%')
+    print(f'Probability of finishing down: {(result.final_bankroll < 1).mean() * 100:.3f}%')
+
+    return
+
+def main(
+    args: argparse.Namespace) -> None:
+
+    client = persistence.create_client(args.backend, host = args.host, directory = args.directory)
+    database = client.get_database(args.database)
+
+    bets = SimulationBets(
+        event.load_all_events_from_database(database),
+        args.snapshot,
+        args.min_kelly,
+        args.multiplier,
+        args.max_stake)
+
+    if not len(bets.stakes):
+        print('No bets qualify; nothing to simulate.')
+        return
+
+    print(f'Simulating {args.paths} paths of {args.season_bets if args.season_bets else len(bets.stakes)} bets (pool of {len(bets.stakes)}, mean stake {bets.stakes.mean() * 100:.2f}%)')
+
+    start = time.perf_counter()
+    result = simulate(
+        bets,
+        args.paths,
+        seed = args.seed,
+        season_bets = args.season_bets,
+        ruin_level = args.ruin_level)
+    print(f'Simulated in {time.perf_counter() - start:.2f} s')
+
+    print_result(result, args.ruin_level)
+
+    return
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description =
+        'Monte Carlo simulation of the bankroll implied by the KenPom \
+        probabilities and Kelly stakes in the recorded line history.')
+
+    parser.add_argument(
+        '--backend',
+        dest = 'backend',
+        choices = [persistence.DB_BACKEND_MONGO, persistence.DB_BACKEND_SQLITE],
+        default = backtest.BACKTEST_DEFAULT_BACKEND,
+        help = 'Database backend holding the line history')
+    parser.add_argument(
+        '--database',
+        dest = 'database',
+        required = True,
+        help = 'Database to load (e.g., cfb, ncaam)')
+    parser.add_argument(
+        '--host',
+        dest = 'host',
+        default = backtest.BACKTEST_DEFAULT_HOST,
+        help = 'MongoDB host')
+    parser.add_argument(
+        '--directory',
+        dest = 'directory',
+        default = backtest.BACKTEST_DEFAULT_DIRECTORY,
+        help = 'SQLite database directory')
+    parser.add_argument(
+        '--snapshot',
+        dest = 'snapshot',
+        choices = backtest.SNAPSHOTS,
+        default = backtest.SNAPSHOT_STARTING,
+        help = 'Snapshot the Kelly values are taken from')
+    parser.add_argument(
+        '--min-kelly',
+        dest = 'min_kelly',
+        type = float,
+        default = SIMULATE_DEFAULT_MIN_KELLY,
+        help = 'Only bet sides whose Kelly value exceeds this')
+    parser.add_argument(
+        '--multiplier',
+        dest = 'multiplier',
+        type = float,
+        default = SIMULATE_DEFAULT_MULTIPLIER,
+        help = 'Fractional Kelly multiplier')
+    parser.add_argument(
+        '--max-stake',
+        dest = 'max_stake',
+        type = float,
+        default = SIMULATE_DEFAULT_MAX_STAKE,
+        help = 'Largest fraction of the bankroll placed on a single bet')
+    parser.add_argument(
+        '--paths',
+        dest = 'paths',
+        type = int,
+        default = SIMULATE_DEFAULT_PATHS,
+        help = 'Number of simulated seasons')
+    parser.add_argument(
+        '--season-bets',
+        dest = 'season_bets',
+        type = int,
+        default = None,
+        help = 'Bets per season drawn from the pool (default: every qualifying bet once)')
+    parser.add_argument(
+        '--ruin-level',
+        dest = 'ruin_level',
+        type = float,
+        default = SIMULATE_DEFAULT_RUIN_LEVEL,
+        help = 'Bankroll fraction that counts as ruin')
+    parser.add_argument(
+        '--seed',
+        dest = 'seed',
+        type = int,
+        default = SIMULATE_DEFAULT_SEED,
+        help = 'Random seed')
+
+    try:
+        args = parser.parse_args()
+    except Exception as e:
+        print(f'An error occurred: {str(e)}')
+        exit(1)
+
+    if args.max_stake >= 1:
+        print('ERROR: --max-stake must be less than the full bankroll; exiting.')
+        exit(1)
+
+    main(args)
+    exit(0)
@@ -0,0 +1,191 @@
+from collections import deque
+import datetime
+import json
+
+STEAM_DEFAULT_WINDOW_MINUTES = 30
+
+# minimum move within the window that counts as steam, per market. spreads
+# and totals are in points, moneylines in implied probability.
+STEAM_SPREAD_POINTS = 1.5
+STEAM_TOTAL_POINTS = 2.0
+STEAM_MONEYLINE_PROBABILITY = 0.05
+
+STEAM_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+ALERT_STEAM = 'steam'
+ALERT_CROSSOVER = 'crossover'
+
+def to_implied_probability(
+    moneyline: float) -> float:
+
+    return 100 / (moneyline + 100) if moneyline > 0 else -moneyline / (-moneyline + 100)
+
+
+class RollingWindow:
+    '''The lowest and highest values of a market seen within a time window.'''
+
+    __slots__ = [
+        'window',
+        'lows',
+        'highs'
+    ]
+
+    def __init__(
+        self,
+        window: datetime.timedelta):
+
+        # monotonic deques of (time, value): the front of each is the extreme
+        # of the window, and every value is pushed and popped at most once.
+        self.window = window
+        self.lows = deque()
+        self.highs = deque()
+
+        return
+
+    def add(
+        self,
+        timestamp: datetime.datetime,
+        value: float) -> None:
+
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((timestamp, value))
+
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((timestamp, value))
+
+        while self.lows[0][0] < timestamp - self.window:
+            self.lows.popleft()
+        while self.highs[0][0] < timestamp - self.window:
+            self.highs.popleft()
+
+        return
+
+    def reset(
+        self,
+        timestamp: datetime.datetime,
+        value: float) -> None:
+
+        # after an alert the move is measured from the new level, so the
+        # same move is not reported again on every poll
+        self.lows.clear()
+        self.highs.clear()
+        self.add(timestamp, value)
+
+        return
+
+
+class SteamDetector:
+    '''Flags sharp line moves as each new snapshot of an event arrives.'''
+
+    __slots__ = [
+        'filename',
+        'window',
+        'windows',
+        'moneylines',
+        'alerts'
+    ]
+
+    # market -> (value of a snapshot, threshold); zero values are missing
+    # lines, except for a spread of zero with odds, which is a pick'em
+    MARKETS = {
+        'away_team_spread': (lambda lines: lines.away_team_spread if lines.away_team_spread or lines.away_team_odds or lines.home_team_odds else None, STEAM_SPREAD_POINTS),
+        'over_under': (lambda lines: lines.over_under if lines.over_under else None, STEAM_TOTAL_POINTS),
+        'away_team_implied_probability': (lambda lines: to_implied_probability(lines.away_team_moneyline) if lines.away_team_moneyline else None, STEAM_MONEYLINE_PROBABILITY)
+    }
+
+    def __init__(
+        self,
+        filename: str,
+        window_minutes: int):
+
+        self.filename = filename
+        self.window = datetime.timedelta(minutes = window_minutes)
+        self.windows = {}
+        self.moneylines = {}
+        self.alerts = []
+
+        return
+
+    def on_update(
+        self,
+        source_event,
+        lines,
+        replay: bool) -> None:
+
+        # history replayed while an event is hydrated from the database only
+        # rebuilds the rolling state; alerts are raised for live updates.
+        try:
+            timestamp = datetime.datetime.strptime(lines.last_updated, STEAM_TIME_FORMAT)
+        except (TypeError, ValueError):
+            return
+
+        for market, (get_value, threshold) in self.MARKETS.items():
+            value = get_value(lines)
+            if not isinstance(value, (int, float)):
+                continue
+
+            key = (source_event.event_id, market)
+            if key not in self.windows:
+                self.windows[key] = RollingWindow(self.window)
+
+            window = self.windows[key]
+            window.add(timestamp, value)
+
+            low_time, low = window.lows[0]
+            high_time, high = window.highs[0]
+            if value - low >= threshold:
+                moved_from, since = low, low_time
+            elif high - value >= threshold:
+                moved_from, since = high, high_time
+            else:
+                continue
+
+            window.reset(timestamp, value)
+            if not replay:
+                self.emit(source_event, lines, ALERT_STEAM, market, moved_from, value, timestamp - since)
+
+        # a moneyline crossover is the favorite flipping sides
+        moneyline = lines.away_team_moneyline
+        if isinstance(moneyline, (int, float)) and moneyline:
+            previous = self.moneylines[source_event.event_id] if source_event.event_id in self.moneylines else None
+            self.moneylines[source_event.event_id] = moneyline
+            if previous and (previous < 0) != (moneyline < 0) and not replay:
+                self.emit(source_event, lines, ALERT_CROSSOVER, 'away_team_moneyline', previous, moneyline, None)
+
+        return
+
+    def emit(
+        self,
+        source_event,
+        lines,
+        alert_type: str,
+        market: str,
+        moved_from: float,
+        moved_to: float,
+        elapsed: datetime.timedelta) -> None:
+
+        alert = {
+            'type': alert_type,
+            'event_id': source_event.event_id,
+            'away_team': source_event.away_team,
+            'home_team': source_event.home_team,
+            'market': market,
+            'from': moved_from,
+            'to': moved_to,
+            'minutes': elapsed.total_seconds() / 60 if elapsed is not None else None,
+            'last_updated': lines.last_updated
+        }
+        self.alerts.append(alert)
+
+        print(f'  ALERT ({alert_type}): {source_event.away_team} @ {source_event.home_team} {market} moved {moved_from:g} -> {moved_to:g}')
+
+        # one json object per line, appended as it happens so that other
+        # tools can tail the log
+        if self.filename:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(alert))
+                f.write('\n')
+
+        return